@@ -1,8 +1,14 @@
+import atexit
+import functools
 import json
-import tempfile
-import warnings
+import multiprocessing
+import os
+import re
+from collections import deque
+from getpass import getuser
 from pathlib import Path
-from queue import Queue
+from queue import Empty, Full, Queue
+from time import ctime
 from typing import Literal
 
 import numpy
@@ -17,6 +23,483 @@ from diffpy.srfit.structure import constrainAsSpaceGroup
 from diffpy.structure.parsers import getParser
 from scipy.optimize import least_squares
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Intermediate results that can be computed directly from the residual
+# vector, without building the full fit results.
+_RESIDUAL_MONITORS = {
+    "residual": lambda residual: float(numpy.dot(residual, residual)),
+}
+
+# Characteristic scales of the recipe variables, keyed by the variable
+# name without the phase and atom suffixes. "s" stands for the phase
+# fractions s1 ... s(n-1).
+_VARIABLE_SCALES = {
+    "s0": 0.1,
+    "s": 0.1,
+    "qdamp": 0.01,
+    "qbroad": 0.01,
+    "delta1": 0.5,
+    "delta2": 0.5,
+    "a": 0.01,
+    "b": 0.01,
+    "c": 0.01,
+    "alpha": 0.1,
+    "beta": 0.1,
+    "gamma": 0.1,
+    "x": 0.001,
+    "y": 0.001,
+    "z": 0.001,
+    "Uiso": 0.001,
+    **{f"U{ij}": 0.001 for ij in ["11", "22", "33", "12", "13", "23"]},
+    "Biso": 0.1,
+    **{f"B{ij}": 0.1 for ij in ["11", "22", "33", "12", "13", "23"]},
+}
+
+
+def _variable_scale(name):
+    """Get the characteristic scale of a recipe variable.
+
+    Parameters
+    ----------
+    name : str
+        The variable name, e.g. "Uiso_phase_1_atom_1" or "s1".
+
+    Returns
+    -------
+    float
+        The preset scale of the variable type, or 1 for unknown types.
+    """
+    prefix = name.split("_")[0]
+    if prefix not in _VARIABLE_SCALES and re.fullmatch(r"s\d+", prefix):
+        prefix = "s"
+    return _VARIABLE_SCALES.get(prefix, 1.0)
+
+
+@functools.lru_cache(maxsize=16)
+def _parse_structure_file(structure_path, mtime_ns):
+    """Parse a CIF structure file and its space group.
+
+    The result is cached on the file path and modification time, so
+    the returned structure must be copied before it is modified.
+
+    Parameters
+    ----------
+    structure_path : str
+        The path to the structure file (CIF format).
+    mtime_ns : int
+        The modification time of the structure file in nanoseconds.
+
+    Returns
+    -------
+    tuple of (Structure, str)
+        The parsed structure and the short name of its space group.
+    """
+    stru_parser = getParser("cif")
+    structure = stru_parser.parse(Path(structure_path).read_text())
+    sg = getattr(stru_parser, "spacegroup", None)
+    spacegroup = sg.short_name if sg is not None else "P1"
+    return structure, spacegroup
+
+
+def _forward_difference_jacobian(fun, x, f0):
+    """Approximate the Jacobian of fun at x with forward differences.
+
+    Parameters
+    ----------
+    fun : callable
+        The residual function.
+    x : numpy.ndarray
+        The point at which to evaluate the Jacobian.
+    f0 : numpy.ndarray
+        The residual at x.
+
+    Returns
+    -------
+    numpy.ndarray
+        The Jacobian with shape (len(f0), len(x)).
+    """
+    jac = numpy.empty((f0.size, x.size))
+    steps = numpy.sqrt(numpy.finfo(float).eps) * numpy.maximum(
+        1.0, numpy.abs(x)
+    )
+    for j, step in enumerate(steps):
+        x_step = x.copy()
+        x_step[j] += step
+        jac[:, j] = (fun(x_step) - f0) / step
+    return jac
+
+
+def _solve_damped(lhs, rhs):
+    """Solve the damped normal equations lhs @ x = rhs.
+
+    A rank-deficient Jacobian, e.g. of a variable with no effect on the
+    residual, can leave lhs singular. The least-squares solution is used
+    then, which does not move the variables along the null space.
+
+    Parameters
+    ----------
+    lhs : numpy.ndarray
+        The damped J^T J matrix.
+    rhs : numpy.ndarray
+        The right-hand side.
+
+    Returns
+    -------
+    numpy.ndarray
+        The solution.
+    """
+    try:
+        return numpy.linalg.solve(lhs, rhs)
+    except numpy.linalg.LinAlgError:
+        return numpy.linalg.lstsq(lhs, rhs, rcond=None)[0]
+
+
+def _geodesic_lm(
+    fun,
+    x0,
+    x_scale="jac",
+    jac0=None,
+    jacobian_refresh=5,
+    max_nfev=None,
+    ftol=1e-8,
+    xtol=1e-8,
+    geodesic_step=0.1,
+    max_acceleration_ratio=0.75,
+    damping_increase=2.0,
+    damping_decrease=3.0,
+):
+    """Minimize the sum of squares of fun with a Levenberg-Marquardt
+    method using delayed gratification and geodesic acceleration.
+
+    The damping is decreased by a larger factor after an accepted step
+    than it is increased after a rejected one, and every step is
+    corrected by the second directional derivative of the residual
+    along it (Transtrum & Sethna, arXiv:1201.5885). Between
+    finite-difference evaluations the Jacobian is kept up to date with
+    Broyden rank-1 updates.
+
+    Parameters
+    ----------
+    fun : callable
+        The residual function.
+    x0 : numpy.ndarray
+        The initial variable values.
+    x_scale : str or numpy.ndarray
+        The characteristic scale of the variables. "jac" uses the
+        diagonal of J^T J as the damping matrix.
+    jac0 : numpy.ndarray
+        The Jacobian to start from, e.g. the one of a previous
+        refinement of a similar problem. Ignored if its shape does not
+        match. Default is to compute it with finite differences.
+    jacobian_refresh : int
+        The number of Broyden updates after which the Jacobian is
+        recomputed with finite differences.
+    max_nfev : int
+        The maximum number of residual evaluations. Default is
+        100 * (len(x0) + 1).
+    ftol : float
+        The tolerance on the relative decrease of the cost.
+    xtol : float
+        The tolerance on the relative step size.
+    geodesic_step : float
+        The finite-difference step along the velocity used to estimate
+        the geodesic acceleration.
+    max_acceleration_ratio : float
+        Steps with 2 |a| / |v| above this ratio are rejected.
+    damping_increase : float
+        The factor to increase the damping by after a rejected step.
+    damping_decrease : float
+        The factor to decrease the damping by after an accepted step.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, numpy.ndarray)
+        The optimized variable values and the last Jacobian.
+    """
+    x = numpy.array(x0, dtype=float)
+    if x.size == 0:
+        return x, None
+    if max_nfev is None:
+        max_nfev = 100 * (x.size + 1)
+    f = fun(x)
+    cost = 0.5 * numpy.dot(f, f)
+    nfev = 1
+    damping = 1e-3
+    jac = None
+    # number of Broyden updates since the last finite-difference Jacobian,
+    # a warm-start Jacobian counts as one
+    updates = 0
+    if jac0 is not None and numpy.shape(jac0) == (f.size, x.size):
+        jac = numpy.array(jac0, dtype=float)
+        updates = 1
+    while nfev < max_nfev:
+        if jac is None or updates >= jacobian_refresh:
+            jac = _forward_difference_jacobian(fun, x, f)
+            nfev += x.size
+            updates = 0
+        jtj = jac.T @ jac
+        gradient = jac.T @ f
+        if not gradient.any():
+            break
+        if isinstance(x_scale, str):
+            dtd = numpy.maximum(numpy.diag(jtj), numpy.finfo(float).eps)
+        else:
+            dtd = 1.0 / numpy.asarray(x_scale, dtype=float) ** 2
+        accepted = False
+        while not accepted and nfev < max_nfev:
+            lhs = jtj + damping * numpy.diag(dtd)
+            velocity = -_solve_damped(lhs, gradient)
+            velocity_norm = numpy.linalg.norm(velocity)
+            if not velocity_norm:
+                # no step can decrease the cost
+                break
+            f_velocity = fun(x + geodesic_step * velocity)
+            second_derivative = (
+                2.0
+                / geodesic_step
+                * ((f_velocity - f) / geodesic_step - jac @ velocity)
+            )
+            acceleration = -_solve_damped(lhs, jac.T @ second_derivative)
+            step = velocity + 0.5 * acceleration
+            f_new = fun(x + step)
+            nfev += 2
+            cost_new = 0.5 * numpy.dot(f_new, f_new)
+            acceleration_ratio = (
+                2.0 * numpy.linalg.norm(acceleration) / velocity_norm
+            )
+            if (
+                acceleration_ratio <= max_acceleration_ratio
+                and cost_new < cost
+            ):
+                accepted = True
+                damping /= damping_decrease
+            else:
+                damping *= damping_increase
+        if not accepted:
+            if updates == 0:
+                break
+            # the approximate Jacobian may be to blame, recompute it
+            jac = None
+            continue
+        converged = (cost - cost_new) <= ftol * cost or numpy.linalg.norm(
+            step
+        ) <= xtol * (xtol + numpy.linalg.norm(x))
+        x = x + step
+        if converged and updates == 0:
+            break
+        if converged:
+            # confirm convergence with a finite-difference Jacobian
+            jac = None
+        else:
+            jac += numpy.outer(f_new - f - jac @ step, step) / numpy.dot(
+                step, step
+            )
+            updates += 1
+        f = f_new
+        cost = cost_new
+    # leave the residual function evaluated at the returned values
+    fun(x)
+    return x, jac
+
+
+@functools.lru_cache(maxsize=None)
+def _default_equation_string(number_of_phase):
+    """Get the default contribution equation for the number of phases.
+
+    Parameters
+    ----------
+    number_of_phase : int
+        The number of phases.
+
+    Returns
+    -------
+    str
+        The equation string, e.g. "s0*G1" for one phase and
+        "s0*(s1*G1+s2*G2+(1-(s1+s2))*G3)" for three phases.
+    """
+    if number_of_phase == 1:
+        return "s0*G1"
+    fractions = [f"s{i}" for i in range(1, number_of_phase)]
+    terms = [f"{s}*G{i}" for i, s in enumerate(fractions, start=1)]
+    terms.append(f"(1-({'+'.join(fractions)}))*G{number_of_phase}")
+    return f"s0*({'+'.join(terms)})"
+
+
+def _has_non_finite(obj):
+    """Check whether the JSON-compatible object holds a NaN or infinite
+    float.
+
+    Parameters
+    ----------
+    obj : object
+        The object, possibly with nested dicts, lists and NumPy arrays.
+
+    Returns
+    -------
+    bool
+        Whether a non-finite float was found.
+    """
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    if isinstance(obj, (float, numpy.floating, numpy.ndarray)):
+        return not numpy.isfinite(obj).all()
+    return False
+
+
+def _json_default(obj):
+    """Convert the NumPy objects that json cannot serialize."""
+    if isinstance(obj, (numpy.ndarray, numpy.generic)):
+        return obj.tolist()
+    raise TypeError(
+        f"Object of type {type(obj).__name__} is not JSON serializable"
+    )
+
+
+def _dump_json(obj, filename):
+    """Write the object to a JSON file, using orjson if available.
+
+    orjson writes non-finite floats as null, so objects holding them are
+    written with json instead, as NaN, Infinity and -Infinity. The file
+    is then the same with and without orjson, and _load_json reads these
+    values back as floats.
+
+    Parameters
+    ----------
+    obj : dict
+        The JSON-compatible object. NumPy arrays and scalars are also
+        accepted.
+    filename : str
+        The path to the output file.
+    """
+    if orjson is not None and not _has_non_finite(obj):
+        with open(filename, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    obj,
+                    option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2,
+                )
+            )
+    else:
+        with open(filename, "w") as f:
+            json.dump(obj, f, indent=2, default=_json_default)
+
+
+def _load_json(filename):
+    """Read a JSON file, using orjson if available.
+
+    Parameters
+    ----------
+    filename : str
+        The path to the JSON file.
+
+    Returns
+    -------
+    object
+        The decoded JSON content.
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # e.g. NaN, which only json accepts
+            pass
+    return json.loads(content)
+
+
+def _load_profile(profile, profile_path, qmin, qmax, xmin, xmax, dx):
+    """Load the PDF profile file into the profile object.
+
+    Parameters
+    ----------
+    profile : Profile
+        The profile to load the data into.
+    profile_path : str
+        The path to the experimental PDF profile file.
+    qmin, qmax : float
+        The Q range for PDF calculation. Default is the parsed one.
+    xmin, xmax, dx : float
+        The r grid for PDF calculation. Default is the observed one.
+    """
+    parser = PDFParser()
+    parser.parseString(Path(profile_path).read_text())
+    profile.loadParsedData(parser)
+    # start from the observed grid, also when reusing a profile
+    profile.setCalculationPoints(profile.xobs)
+    if qmin:
+        profile.meta["qmin"] = qmin
+    if qmax:
+        profile.meta["qmax"] = qmax
+    profile.setCalculationRange(xmin=xmin, xmax=xmax, dx=dx)
+
+
+def _put_nowait(queue, value):
+    """Put a value into the queue or deque without blocking.
+
+    A full queue or deque drops its oldest value, so it always holds the
+    latest values.
+    """
+    if isinstance(queue, deque):
+        queue.append(value)
+        return
+    while True:
+        try:
+            queue.put_nowait(value)
+            return
+        except Full:
+            try:
+                queue.get_nowait()
+                queue.task_done()
+            except Empty:
+                pass
+
+
+_pool = None
+
+
+def _get_pool():
+    """Get the worker pool shared by all parallel PDF generators.
+
+    The pool is created on the first call and closed at interpreter
+    exit. Its number of processes is read from the PDFBL_NCPU
+    environment variable, and defaults to the number of CPUs minus one
+    to leave a core for the main process.
+
+    Returns
+    -------
+    tuple of (multiprocessing.pool.Pool, int)
+        The worker pool and its number of processes.
+
+    Raises
+    ------
+    ValueError
+        If PDFBL_NCPU is not an integer.
+    """
+    global _pool
+    if _pool is None:
+        ncpu = os.environ.get("PDFBL_NCPU")
+        if ncpu is None:
+            ncpu = (os.cpu_count() or 1) - 1
+        else:
+            try:
+                ncpu = int(ncpu)
+            except ValueError:
+                raise ValueError(
+                    f"PDFBL_NCPU must be an integer, got '{ncpu}'. Please "
+                    "set it to the number of worker processes."
+                ) from None
+        ncpu = max(1, ncpu)
+        _pool = (multiprocessing.Pool(processes=ncpu), ncpu)
+        atexit.register(_pool[0].close)
+    return _pool
+
 
 class PDFAdapter:
     """Adapter to expose PDF fitting interface. Designed to provide a
@@ -32,6 +515,8 @@ class PDFAdapter:
     initialize_profile(profile_path, qmin=None, qmax=None, xmin=None, xmax=None, dx=None)
         Load and initialize the PDF profile from the given file path with
         some optional parameters.
+    update_profile(profile_path, qmin=None, qmax=None, xmin=None, xmax=None, dx=None)
+        Load a new PDF profile into the existing recipe.
     initialize_structures(structure_paths : list[str], run_parallel=True)
         Load and initialize the structures from the given file paths, and
         generate corresponding PDFGenerator objects.
@@ -42,7 +527,7 @@ class PDFAdapter:
         Initialize the FitRecipe object for the fitting process.
     set_initial_variable_values(variable_name_to_value : dict)
         Update parameter values from the provided dictionary.
-    refine_variables(variable_names: list[str])
+    refine_variables(variable_names: list[str], x_scale="jac", method="trf", intermediate_max_nfev=None)
         Refine the parameters specified in the list and in that order.
     get_variable_names()
         Get the names of all variables in the recipe.
@@ -50,26 +535,41 @@ class PDFAdapter:
         Save the fitting results.
     """  # noqa: E501
 
+    _parallel_threshold = 100_000
+
     def __init__(self):
         self.intermediate_results = {}
         self.iter_count = 0
+        self._jacobians = {}
 
     def monitor_intermediate_results(
-        self, key: str, step: int = 10, queue: Queue = None
+        self,
+        key: str,
+        step: int = 10,
+        queue: Queue = None,
+        maxsize: int = 0,
     ):
         """Store an intermediate result during the fitting process.
 
+        Results are put without blocking, so a full queue drops its
+        oldest result instead of stalling the refinement.
+
         Parameters
         ----------
         key : str
             The key to identify the intermediate result.
         step : int
             The step interval to store the intermediate result.
-        queue : Queue
-            The queue to store the intermediate results.
+        queue : Queue or collections.deque
+            The queue to store the intermediate results. Default is a new
+            queue of the given maxsize.
+        maxsize : int
+            The number of latest results kept by the default queue, e.g.
+            2 to only watch the progress of a long refinement. Default is
+            0, which keeps every result. Ignored if queue is given.
         """
         if queue is None:
-            queue = Queue()
+            queue = Queue(maxsize=maxsize)
         self.intermediate_results[(key, step)] = queue
 
     def initialize_profile(
@@ -109,16 +609,60 @@ class PDFAdapter:
             one parsed from the profile file.
         """
         profile = Profile()
-        parser = PDFParser()
-        parser.parseString(Path(profile_path).read_text())
-        profile.loadParsedData(parser)
-        if qmin:
-            profile.meta["qmin"] = qmin
-        if qmax:
-            profile.meta["qmax"] = qmax
-        profile.setCalculationRange(xmin=xmin, xmax=xmax, dx=dx)
+        _load_profile(profile, profile_path, qmin, qmax, xmin, xmax, dx)
         self.profile = profile
 
+    def update_profile(
+        self,
+        profile_path: str,
+        qmin=None,
+        qmax=None,
+        xmin=None,
+        xmax=None,
+        dx=None,
+    ):
+        """Load a new PDF profile into the existing recipe.
+
+        This is a faster alternative to calling all initialize methods
+        again when only the profile changes, e.g. in a sequential
+        refinement. The variable values are kept and all variables are
+        fixed again, as after initialize_recipe.
+
+        Must be called after initialize_recipe.
+
+        Parameters
+        ----------
+        profile_path : str
+            The path to the experimental PDF profile file.
+        qmin : float
+            The minimum Q value for PDF calculation. The default value is
+            the one parsed from the profile file.
+        qmax : float
+            The maximum Q value for PDF calculation. The default value is
+            the one parsed from the profile file.
+        xmin : float
+            The minimum r value for PDF calculation. The default value is
+            the one parsed from the profile file.
+        xmax : float
+            The maximum r value for PDF calculation. The default value is
+            the one parsed from the profile file.
+        dx : float
+            The r step size for PDF calculation. The default value is the
+            one parsed from the profile file.
+        """
+        _load_profile(self.profile, profile_path, qmin, qmax, xmin, xmax, dx)
+        # the generators merge the profile metadata into their own, so
+        # reset them to match freshly built ones before they pick up the
+        # new qmin and qmax
+        default_qmin, default_qmax, default_stype = self._generator_defaults
+        for pdfgenerator in self.pdfgenerators:
+            pdfgenerator.setQmin(default_qmin)
+            pdfgenerator.setQmax(default_qmax)
+            pdfgenerator.setScatteringType(default_stype)
+            pdfgenerator.meta.clear()
+        self.contribution.setProfile(self.profile)
+        self.recipe.fix("all")
+
     def initialize_structures(
         self, structure_paths: list[str], run_parallel=True
     ):
@@ -135,6 +679,10 @@ class PDFAdapter:
         ----------
         structure_paths : list of str
             The list of paths to the structure files (CIF format).
+        run_parallel : bool
+            Whether to calculate the PDFs in parallel. Only used for
+            structures whose number of atoms times the number of profile
+            points is at least _parallel_threshold.
 
         Notes
         -----
@@ -148,37 +696,28 @@ class PDFAdapter:
         structures = []
         spacegroups = []
         pdfgenerators = []
-        if run_parallel:
-            try:
-                import multiprocessing
-                from multiprocessing import Pool
-
-                import psutil
-
-                syst_cores = multiprocessing.cpu_count()
-                cpu_percent = psutil.cpu_percent()
-                avail_cores = numpy.floor(
-                    (100 - cpu_percent) / (100.0 / syst_cores)
-                )
-                ncpu = int(numpy.max([1, avail_cores]))
-                pool = Pool(processes=ncpu)
-                self.pool = pool
-            except ImportError:
-                warnings.warn(
-                    "\nYou don't appear to have the necessary packages for "
-                    "parallelization. Proceeding without parallelization."
-                )
-                run_parallel = False
         for i, structure_path in enumerate(structure_paths):
-            stru_parser = getParser("cif")
-            structure = stru_parser.parse(Path(structure_path).read_text())
-            sg = getattr(stru_parser, "spacegroup", None)
-            spacegroup = sg.short_name if sg is not None else "P1"
+            structure, spacegroup = _parse_structure_file(
+                str(structure_path), Path(structure_path).stat().st_mtime_ns
+            )
+            structure = structure.copy()
             structures.append(structure)
             spacegroups.append(spacegroup)
             pdfgenerator = PDFGenerator(f"G{i+1}")
             pdfgenerator.setStructure(structure)
-            if run_parallel:
+            # restored by update_profile
+            self._generator_defaults = (
+                pdfgenerator.getQmin(),
+                pdfgenerator.getQmax(),
+                pdfgenerator.getScatteringType(),
+            )
+            # the pool overhead outweighs the gain for small problems
+            if (
+                run_parallel
+                and len(self.profile.x) * len(structure)
+                >= self._parallel_threshold
+            ):
+                self.pool, ncpu = _get_pool()
                 pdfgenerator.parallel(ncpu=ncpu, mapfunc=self.pool.map)
             pdfgenerators.append(pdfgenerator)
         self.spacegroups = spacegroups
@@ -217,17 +756,7 @@ class PDFAdapter:
             contribution.addProfileGenerator(pdfgenerator)
         number_of_phase = len(self.pdfgenerators)
         if equation_string is None:
-            if number_of_phase == 1:
-                equation_string = "s0*G1"
-            else:
-                equation_string = (
-                    "s0*("
-                    + "+".join(
-                        [f"s{i+1}*G{i+1}" for i in range(number_of_phase - 1)]
-                    )
-                    + f"+(1-({'+'.join([f's{i+1}' for i in range(1, number_of_phase)])}))*G{number_of_phase}"  # noqa: E501
-                    + ")"
-                )
+            equation_string = _default_equation_string(number_of_phase)
         contribution.setEquation(equation_string)
         self.contribution = contribution
         return self.contribution
@@ -275,11 +804,13 @@ class PDFAdapter:
                 recipe.addVar(
                     par, name=modify_lat_delta_name(pname, i), fixed=False
                 )
-            if len(self.pdfgenerators) > 1:
+            # the last phase fraction is one minus the others
+            if i < len(self.pdfgenerators) - 1:
                 recipe.addVar(
                     getattr(self.contribution, f"s{i+1}"),
                     name=f"s{i+1}",
                     fixed=False,
+                    value=1.0 / len(self.pdfgenerators),
                 )
                 recipe.restrain(f"s{i+1}", lb=0.0, ub=1.0)
             recipe.constrain(pdfgenerator.qdamp, qdamp)
@@ -302,6 +833,45 @@ class PDFAdapter:
         recipe.fix("all")
         recipe.fithooks[0].verbose = 0
         self.recipe = recipe
+        self._fit_results = FitResults(recipe, update=False)
+
+    @classmethod
+    def list_recipe_parameters(cls, structure_paths: list[str]):
+        """List the names of the recipe variables built from the
+        structure files.
+
+        The recipe is built on an empty profile, so no data file is
+        loaded and no parallel PDF calculation is set up.
+
+        Parameters
+        ----------
+        structure_paths : list of str
+            The list of paths to the structure files (CIF format).
+
+        Returns
+        -------
+        list of str
+            The names of the recipe variables.
+        """
+        adapter = cls()
+        adapter.profile = Profile()
+        adapter.initialize_structures(structure_paths, run_parallel=False)
+        adapter.initialize_contribution()
+        adapter.initialize_recipe()
+        return list(adapter.recipe._parameters.keys())
+
+    def snapshot_values(self):
+        """Get the current values of all the recipe variables.
+
+        Returns
+        -------
+        dict
+            A dictionary mapping variable names to their values.
+        """
+        return {
+            name: parameter.value
+            for name, parameter in self.recipe._parameters.items()
+        }
 
     def set_initial_variable_values(self, variable_name_to_value: dict):
         """Update parameter values from the provided dictionary.
@@ -311,8 +881,9 @@ class PDFAdapter:
         variable_name_to_value : dict
             A dictionary mapping variable names to their new values.
         """
+        parameters = self.recipe._parameters
         for vname, vvalue in variable_name_to_value.items():
-            self.recipe._parameters[vname].setValue(vvalue)
+            parameters[vname].setValue(vvalue)
 
     def residual(self, p=[]):
         """Wrapper for the recipe residual function to store
@@ -329,22 +900,38 @@ class PDFAdapter:
             The residual array.
         """
         residual = self.recipe.residual(p)
-        fitresults_dict = None
-        for (key, step), values in self.intermediate_results.items():
-            if (self.iter_count % step) == 0:
-                if fitresults_dict is None:
-                    fitresults_dict = self.save_results(mode="dict")
-                value = fitresults_dict.get(key, None)
-                if value is None:
-                    raise KeyError(
-                        f"{key} is not found in the fit results. "
-                        f"Available keys are: {list(fitresults_dict.keys())}"
-                    )
-                values.put(value)
+        fired = [
+            (key, values)
+            for (key, step), values in self.intermediate_results.items()
+            if self.iter_count % step == 0
+        ]
         self.iter_count += 1
+        if not fired:
+            return residual
+        fitresults_dict = None
+        for key, values in fired:
+            if key in _RESIDUAL_MONITORS:
+                _put_nowait(values, _RESIDUAL_MONITORS[key](residual))
+                continue
+            if fitresults_dict is None:
+                fitresults_dict = self.save_results(mode="dict")
+            value = fitresults_dict.get(key, None)
+            if value is None:
+                raise KeyError(
+                    f"{key} is not found in the fit results. "
+                    f"Available keys are: {list(fitresults_dict.keys())}"
+                )
+            _put_nowait(values, value)
         return residual
 
-    def refine_variables(self, variable_names: list[str]):
+    def refine_variables(
+        self,
+        variable_names: list[str],
+        x_scale: Literal["jac", "preset"] = "jac",
+        method: Literal["trf", "geodesic-lm"] = "trf",
+        intermediate_max_nfev: int = None,
+        strategy: Literal["staged", "joint"] = "staged",
+    ):
         """Refine the parameters specified in the list and in that
         order. Must be called after initialize_recipe.
 
@@ -352,6 +939,38 @@ class PDFAdapter:
         ----------
         variable_names : list of str
             The names of the variables to refine.
+        x_scale : str
+            The characteristic scale of the variables. Options are:
+                "jac" - Scale by the inverse norms of the Jacobian columns.
+                "preset" - Use preset scales by variable type (qdamp,
+                Uiso, ...), falling back to 1 for unknown types.
+        method : str
+            The least-squares method. Options are:
+                "trf" - scipy.optimize.least_squares with the trust
+                region reflective method.
+                "geodesic-lm" - Levenberg-Marquardt with delayed
+                gratification damping and geodesic acceleration, which
+                needs fewer iterations in narrow, curved valleys of the
+                cost function. The Jacobian of the last refinement with
+                the same free variables is used as the starting point,
+                which speeds up sequential refinements of similar data.
+                The Jacobians are kept by the tuple of free variable
+                names, also across update_profile, and one whose shape
+                does not match the new residual, e.g. after a change of
+                the r grid, is ignored.
+        intermediate_max_nfev : int
+            The maximum number of residual evaluations of every stage but
+            the last one. The stages only need to bring the newly freed
+            variable close to its optimum, which the last stage then
+            refines with the full tolerance. Default is no limit.
+        strategy : str
+            How the variables are freed. Options are:
+                "staged" - Free the variables one at a time in the given
+                order, and refine after each one.
+                "joint" - Free all the variables and refine them once,
+                which saves the setup of the intermediate stages but
+                needs starting values close to the optimum, e.g. those
+                of a previous refinement of similar data.
         """
         for vname in variable_names:
             if vname not in self.recipe._parameters:
@@ -360,13 +979,36 @@ class PDFAdapter:
                     "Please choose from the existing variables: "
                     f"{list(self.recipe._parameters.keys())}"
                 )
-        for vname in variable_names:
-            self.recipe.free(vname)
-            least_squares(
-                self.residual,
-                self.recipe.values,
-                x_scale="jac",
-            )
+        if strategy == "joint":
+            stages = [variable_names]
+        else:
+            stages = [[vname] for vname in variable_names]
+        for stage, stage_variable_names in enumerate(stages, start=1):
+            for vname in stage_variable_names:
+                self.recipe.free(vname)
+            max_nfev = intermediate_max_nfev if stage < len(stages) else None
+            if x_scale == "preset":
+                scales = numpy.array(
+                    [_variable_scale(name) for name in self.recipe.names]
+                )
+            else:
+                scales = x_scale
+            if method == "geodesic-lm":
+                free_names = tuple(self.recipe.names)
+                _, self._jacobians[free_names] = _geodesic_lm(
+                    self.residual,
+                    self.recipe.values,
+                    x_scale=scales,
+                    jac0=self._jacobians.get(free_names),
+                    max_nfev=max_nfev,
+                )
+            else:
+                least_squares(
+                    self.residual,
+                    self.recipe.values,
+                    x_scale=scales,
+                    max_nfev=max_nfev,
+                )
 
     def get_variable_names(self) -> list[str]:
         """Get the names of all variables in the recipe.
@@ -399,17 +1041,21 @@ class PDFAdapter:
         str or dict
             The fitting results in the specified format.
         """
-        fit_results = FitResults(self.recipe)
+        if not self.recipe.names:
+            # FitResults.update() only computes the uncertainties of free
+            # variables, so start over instead of keeping the old ones
+            self._fit_results = FitResults(self.recipe, update=False)
+        fit_results = self._fit_results
+        # FitResults.update() appends to the messages and never clears them
+        fit_results.messages = []
+        fit_results.update()
         if mode == "str":
-            if filename is None:
-                tmp_directory = tempfile.TemporaryDirectory()
-                temp_file = Path(tmp_directory.name) / "data.txt"
-                filename = str(temp_file)
-            fit_results.saveResults(filename)
-            with open(filename, "r") as f:
-                results_str = f.read()
-            if filename is None:
-                tmp_directory.cleanup()
+            # same header as FitResults.saveResults
+            header = f"Results written: {ctime()}\nproduced by {getuser()}\n"
+            results_str = fit_results.formatResults(header=header)
+            if filename is not None:
+                with open(filename, "w") as f:
+                    f.write(results_str)
             return results_str
 
         elif mode == "dict":
@@ -441,27 +1087,24 @@ class PDFAdapter:
             # constraints
             results_dict["constraints"] = {}
             if fit_results.connames and fit_results.showcon:
-                for con in fit_results.conresults.values():
-                    for i, loc in enumerate(con.conlocs):
-                        names = [obj.name for obj in loc]
-                        name = ".".join(names)
-                        val = con.convals[i]
-                        unc = con.conuncs[i]
-                        results_dict["constraints"][name] = {
-                            "value": val,
-                            "uncertainty": unc,
-                        }
+                results_dict["constraints"] = {
+                    ".".join(obj.name for obj in loc): {
+                        "value": val,
+                        "uncertainty": unc,
+                    }
+                    for con in fit_results.conresults.values()
+                    for loc, val, unc in zip(
+                        con.conlocs, con.convals, con.conuncs
+                    )
+                }
             # covariance matrix
             results_dict["covariance_matrix"] = fit_results.cov.tolist()
-            # certainty
-            certain = True
-            for con in fit_results.conresults.values():
-                if (con.dy == 1).all():
-                    certain = False
-            results_dict["certain"] = certain
+            # certainty, profiles without uncertainties have dy == 1
+            results_dict["certain"] = not any(
+                (con.dy == 1).all() for con in fit_results.conresults.values()
+            )
             if filename is not None:
-                with open(filename, "w") as f:
-                    json.dump(results_dict, f, indent=2)
+                _dump_json(results_dict, filename)
             return results_dict
 
         else:
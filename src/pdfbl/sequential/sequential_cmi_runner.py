@@ -1,87 +1,330 @@
+import hashlib
 import json
+import os
 import re
 import threading
 import time
 import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from queue import Queue
 from types import SimpleNamespace
 from typing import Literal
 
-from bg_mpl_stylesheets.styles import all_styles
+import numpy
 from matplotlib import pyplot as plt
-from prompt_toolkit import PromptSession
-from prompt_toolkit.patch_stdout import patch_stdout
 
-from pdfbl.sequential.pdfadapter import PDFAdapter
+from pdfbl.sequential.pdfadapter import PDFAdapter, _dump_json, _load_json
 
-plt.style.use(all_styles["bg-style"])
+
+def _file_fingerprint(path):
+    """Fingerprint a file from its first 4 KiB, size and mtime.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The file to fingerprint.
+
+    Returns
+    -------
+    str
+        The fingerprint of the file.
+    """
+    stat = path.stat()
+    with open(path, "rb") as f:
+        digest = hashlib.sha1(f.read(4096)).hexdigest()
+    return f"{digest}-{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def _refine_file(input_file, inputs, variable_values):
+    """Refine one input file with its own PDFAdapter.
+
+    This is run in the worker processes of the parallel batch mode.
+
+    Parameters
+    ----------
+    input_file : pathlib.Path
+        The input data file to refine.
+    inputs : dict
+        The inputs of the runner, as set by ``load_inputs``.
+    variable_values : dict
+        The starting values of the variables.
+
+    Returns
+    -------
+    results : dict
+        The fit results, as returned by ``save_results(mode="dict")``.
+    values : dict
+        The refined values of all the recipe parameters.
+    profile : tuple of numpy.ndarray
+        The x, y and ycalc arrays of the refined profile.
+    """
+    adapter = PDFAdapter()
+    adapter.initialize_profile(
+        str(input_file),
+        xmin=inputs["xmin"],
+        xmax=inputs["xmax"],
+        dx=inputs["dx"],
+        qmin=inputs["qmin"],
+        qmax=inputs["qmax"],
+    )
+    # the worker processes are already parallel, so the structure must
+    # not start a pool of its own
+    adapter.initialize_structures(
+        [inputs["structure_path"]], run_parallel=False
+    )
+    adapter.initialize_contribution()
+    adapter.initialize_recipe()
+    adapter.set_initial_variable_values(variable_values)
+    adapter.refine_variables(inputs["refinable_variable_names"])
+    results = adapter.save_results(mode="dict")
+    values = adapter.snapshot_values()
+    profile = adapter.profile
+    return results, values, (profile.x, profile.y, profile.ycalc)
 
 
 class SequentialCMIRunner:
+    _allowed_variable_names_cache = {}
+    _max_profile_plot_points = 2048
+    # fingerprints of the refined input files, kept in the output
+    # result directory so that a restarted run skips them
+    _completed_fingerprints_filename = ".completed.json"
+    # in stream mode, a new input file that the watcher has not reported
+    # as written is only taken once it has not changed for this long
+    _input_settle_time_ns = 1_000_000_000
+
     def __init__(self):
         self.input_files_known = []
+        self._input_file_names = []
         self.input_files_completed = []
         self.input_files_running = []
-        self.adapter = PDFAdapter()
+        self._adapter = None
         self.visualization_data = {}
+        self._profile_plot_packs = []
+        self._series_plot_packs = []
+        self._recipe_initialized = False
+        self._completed_fingerprints = {}
+        self._result_queue = Queue(maxsize=4)
+        self._writer = None
+        self._write_error = None
+        # names of the input files reported as written by the watcher,
+        # None outside of stream mode
+        self._written_input_names = None
+
+    @property
+    def adapter(self):
+        """The PDFAdapter running the refinements, created on first
+        use."""
+        if self._adapter is None:
+            self._adapter = PDFAdapter()
+        return self._adapter
+
+    def _write_result(self, results, filename, input_file, fingerprint):
+        _dump_json(results, filename)
+        # the file is only marked as completed once its results are
+        # written, and the sidecar is replaced atomically
+        self._completed_fingerprints[input_file.name] = fingerprint
+        sidecar = self._completed_fingerprints_file
+        _dump_json(self._completed_fingerprints, sidecar.with_suffix(".tmp"))
+        os.replace(sidecar.with_suffix(".tmp"), sidecar)
+
+    def _write_results(self):
+        while True:
+            item = self._result_queue.get()
+            if item is None:
+                self._result_queue.task_done()
+                return
+            try:
+                self._write_result(*item)
+            except Exception as error:
+                # keep writing the other results, the first error is
+                # raised by _stop_writer
+                if self._write_error is None:
+                    self._write_error = error
+            finally:
+                self._result_queue.task_done()
+
+    def _start_writer(self):
+        """Start the thread writing the queued results.
+
+        Returns
+        -------
+        threading.Thread
+            The writer thread, to be passed to ``_stop_writer``.
+        """
+        self._write_error = None
+        self._writer = threading.Thread(
+            target=self._write_results, daemon=True
+        )
+        self._writer.start()
+        return self._writer
+
+    def _stop_writer(self, writer, raise_error=True):
+        """Wait for the queued results to be written and stop the writer
+        thread.
+
+        Parameters
+        ----------
+        writer : threading.Thread
+            The writer thread returned by ``_start_writer``.
+        raise_error : bool
+            Whether to raise the first write error. False when another
+            error is already being raised, which it must not replace.
+
+        Raises
+        ------
+        Exception
+            The first error raised while writing the results.
+        """
+        self._result_queue.put(None)
+        writer.join()
+        self._writer = None
+        error, self._write_error = self._write_error, None
+        if error is not None and raise_error:
+            raise error
+
+    def _result_file(self, input_file):
+        return self._output_result_dir / f"{input_file.stem}_result.json"
+
+    def _refinement_fingerprint(self):
+        """Fingerprint the refinement settings shared by all the files.
+
+        A result is only reused if the structure file, the file order,
+        the variables, their initial values and the r and Q ranges are
+        the same as when it was refined.
+        """
+        settings = {
+            name: self.inputs[name]
+            for name in [
+                "filename_order_pattern",
+                "refinable_variable_names",
+                "initial_variable_values",
+                "xmin",
+                "xmax",
+                "dx",
+                "qmin",
+                "qmax",
+            ]
+        }
+        settings["structure"] = _file_fingerprint(
+            Path(self.inputs["structure_path"])
+        )
+        settings_json = json.dumps(settings, sort_keys=True, default=str)
+        return hashlib.sha1(settings_json.encode()).hexdigest()
+
+    def _input_fingerprint(self, input_file):
+        return f"{_file_fingerprint(input_file)}-{self._settings_fingerprint}"
+
+    def _skip_completed(self, input_file):
+        """Skip an input file refined in an earlier run.
+
+        The file is skipped if its fingerprint, which also covers the
+        refinement settings, matches the one recorded when it was
+        refined and its result file still exists. The refined variable
+        values are then read from the result file, on top of the initial
+        values, to start the next file from.
+
+        Each file starts from the result of the previous one, so once a
+        file is refined again, the results of the following files are
+        stale and no file is skipped for the rest of the run.
+
+        Parameters
+        ----------
+        input_file : pathlib.Path
+            The input data file.
+
+        Returns
+        -------
+        bool
+            Whether the file was skipped.
+        """
+        if not self._skipping_completed:
+            return False
+        fingerprint = self._completed_fingerprints.get(input_file.name)
+        result_file = self._result_file(input_file)
+        if (
+            fingerprint is None
+            or fingerprint != self._input_fingerprint(input_file)
+            or not result_file.exists()
+        ):
+            self._skipping_completed = False
+            return False
+        # the variables that are not refined keep their initial values
+        self.last_result_variables_values = {
+            **self.inputs["initial_variable_values"],
+            **{
+                name: pack["value"]
+                for name, pack in _load_json(result_file)["variables"].items()
+            },
+        }
+        self.input_files_completed.append(input_file)
+        print(f"Skipping {input_file.name}, already refined.")
+        return True
 
     def _validate_inputs(self):
         for path_name in [
             "input_data_dir",
             "output_result_dir",
         ]:
-            if not Path(self.inputs[path_name]).exists():
+            path = self.inputs[path_name]
+            # one stat for a valid directory, the second one only tells
+            # the two errors apart
+            if os.path.isdir(path):
+                continue
+            if not os.path.exists(path):
                 raise FileNotFoundError(
                     f"Path '{self.inputs[path_name]}' for "
                     f"'{path_name}' does not exist. Please check the "
                     "provided path."
                 )
-            if not Path(self.inputs[path_name]).is_dir():
-                raise NotADirectoryError(
-                    f"Path '{self.inputs[path_name]}' for "
-                    f"'{path_name}' is not a directory. Please check the "
-                    "provided path."
-                )
-        if not Path(self.inputs["structure_path"]).exists():
+            raise NotADirectoryError(
+                f"Path '{self.inputs[path_name]}' for "
+                f"'{path_name}' is not a directory. Please check the "
+                "provided path."
+            )
+        if not os.path.exists(self.inputs["structure_path"]):
             raise FileNotFoundError(
                 f"Structure file '{self.inputs['structure_path']}' does not "
                 "exist. Please check the provided path."
             )
-        profile_files = list(Path(self.inputs["input_data_dir"]).glob("*"))
+        with os.scandir(self.inputs["input_data_dir"]) as entries:
+            profile_files = list(entries)
         if len(profile_files) > 0:  # skip variable checking if no input files
             for tmp_file_path in profile_files:
-                matches = re.findall(
-                    self.inputs["filename_order_pattern"], tmp_file_path.name
-                )
-                if len(matches) == 0:
+                if self._filename_order_re.search(tmp_file_path.name) is None:
                     raise ValueError(
-                        f"Input file '{tmp_file_path}' does not match the "
-                        "filename order pattern. Please check the pattern "
+                        f"Input file '{tmp_file_path.path}' does not match "
+                        "the filename order pattern. Please check the pattern "
                         "or the input files."
                     )
-            tmp_adatper = PDFAdapter()
-            tmp_adatper.initialize_profile(str(tmp_file_path))
-            tmp_adatper.initialize_structures([self.inputs["structure_path"]])
-            tmp_adatper.initialize_contribution()
-            tmp_adatper.initialize_recipe()
-            allowed_variable_names = list(
-                tmp_adatper.recipe._parameters.keys()
+            allowed_variable_names = self._get_allowed_variable_names(
+                self.inputs["structure_path"]
             )
-            for var_name in self.inputs["refinable_variable_names"]:
-                if var_name not in allowed_variable_names:
-                    raise ValueError(
-                        f"Refinable variable '{var_name}' not found in the "
-                        "recipe. Please choose from the existing variables: "
-                        f"{allowed_variable_names}"
-                    )
-            for var_name in self.inputs.get("plot_variable_names", []):
-                if var_name not in allowed_variable_names:
-                    raise ValueError(
-                        f"Variable '{var_name}' is not found in the recipe. "
-                        "Please choose from the existing variables: "
-                        f"{allowed_variable_names}"
-                    )
+            allowed_variable_name_set = set(allowed_variable_names)
+            # report all the unknown names at once
+            missing_names = ", ".join(
+                f"'{var_name}'"
+                for var_name in self.inputs["refinable_variable_names"]
+                if var_name not in allowed_variable_name_set
+            )
+            if missing_names:
+                raise ValueError(
+                    f"Refinable variable {missing_names} not found in the "
+                    "recipe. Please choose from the existing variables: "
+                    f"{allowed_variable_names}"
+                )
+            missing_names = ", ".join(
+                f"'{var_name}'"
+                for var_name in self.inputs.get("plot_variable_names", [])
+                if var_name not in allowed_variable_name_set
+            )
+            if missing_names:
+                raise ValueError(
+                    f"Variable {missing_names} is not found in the recipe. "
+                    "Please choose from the existing variables: "
+                    f"{allowed_variable_names}"
+                )
         else:
             warnings.warn(
                 "No input profile files found in the input data directory. "
@@ -112,6 +355,21 @@ class SequentialCMIRunner:
                     f"{allowed_result_entry_names}"
                 )
 
+    @classmethod
+    def _get_allowed_variable_names(cls, structure_path):
+        """Get the variable names of the recipe built from the structure
+        file.
+
+        The names only depend on the structure, so they are cached by
+        the structure path and modification time.
+        """
+        key = (str(structure_path), os.path.getmtime(structure_path))
+        if key not in cls._allowed_variable_names_cache:
+            cls._allowed_variable_names_cache[key] = (
+                PDFAdapter.list_recipe_parameters([structure_path])
+            )
+        return cls._allowed_variable_names_cache[key]
+
     def load_inputs(
         self,
         input_data_dir,
@@ -123,6 +381,7 @@ class SequentialCMIRunner:
         plot_variable_names=None,
         plot_result_names=None,
         plot_intermediate_result_names=None,
+        intermediate_result_step=10,
         refinable_variable_names=None,
         initial_variable_values=None,
         xmin=None,
@@ -194,6 +453,9 @@ class SequentialCMIRunner:
             The list of intermediate result entries to plot during refinement.
             Allowed values: "residual", "contributions", "restraints", "chi2",
             "reduced_chi2". Default is None.
+        intermediate_result_step : int
+            The number of residual evaluations between two plotted
+            intermediate results. Default is 10.
 
         Raises
         ------
@@ -237,12 +499,42 @@ class SequentialCMIRunner:
             "plot_result_names": plot_result_names or [],
             "plot_intermediate_result_names": plot_intermediate_result_names
             or [],
+            "intermediate_result_step": intermediate_result_step,
         }
         self.show_plot = show_plot
+        self._recipe_initialized = False
+        self._filename_order_re = re.compile(filename_order_pattern)
+        self._filename_orders = {}
+        self._input_dir_mtime_ns = None
         self._validate_inputs()
+        self._settings_fingerprint = self._refinement_fingerprint()
+        # built once, the result paths are derived from it for every file
+        self._output_result_dir = Path(output_result_dir)
+        self._completed_fingerprints_file = (
+            self._output_result_dir / self._completed_fingerprints_filename
+        )
+        self._completed_fingerprints = (
+            _load_json(self._completed_fingerprints_file)
+            if self._completed_fingerprints_file.exists()
+            else {}
+        )
+        # only the leading completed files are skipped, see
+        # _skip_completed
+        self._skipping_completed = True
         self._initialize_plots()
 
     def _initialize_plots(self):
+        from bg_mpl_stylesheets.styles import all_styles
+
+        plt.style.use(all_styles["bg-style"])
+        # flat lists of the plot packs in visualization_data, so that
+        # _update_plot does not walk the nested dict
+        self._profile_plot_packs = []
+        self._series_plot_packs = []
+        # the lines are animated, they are blitted onto the background
+        # cached at the last full draw of their figure
+        self._figure_lines = {}
+        self._figure_backgrounds = {}
         whether_plot_y = self.inputs["whether_plot_y"]
         whether_plot_ycalc = self.inputs["whether_plot_ycalc"]
         plot_variable_names = self.inputs["plot_variable_names"]
@@ -270,13 +562,18 @@ class SequentialCMIRunner:
                     [],
                     label=label[i],
                     color=plt.rcParams["axes.prop_cycle"].by_key()["color"][i],
+                    animated=True,
                 )
                 lines.append(line)
+                # only the latest (x, y) pair is plotted
                 self.visualization_data[label[i]] = {
                     "line": line,
-                    "xdata": Queue(),
-                    "ydata": Queue(),
+                    "data": deque(maxlen=1),
+                    "view": None,
                 }
+                self._profile_plot_packs.append(
+                    self.visualization_data[label[i]]
+                )
             fig.legend()
         names = ["variables", "results", "intermediate_results"]
         plot_tasks = [
@@ -287,83 +584,292 @@ class SequentialCMIRunner:
         for i in range(len(plot_tasks)):
             if plot_tasks[i] is not None:
                 self.visualization_data[names[i]] = {}
-                for var_name in plot_tasks[i]:
-                    fig, ax = plt.subplots()
-                    (line,) = ax.plot([], [], label=var_name, marker="o")
+                if not plot_tasks[i]:
+                    continue
+                # one figure per category, with one panel per name
+                fig, axes = plt.subplots(
+                    len(plot_tasks[i]), 1, sharex=True, squeeze=False
+                )
+                fig.suptitle(names[i].capitalize())
+                for var_name, (ax,) in zip(plot_tasks[i], axes):
+                    (line,) = ax.plot(
+                        [], [], label=var_name, marker="o", animated=True
+                    )
+                    ax.set_title(var_name)
                     self.visualization_data[names[i]][var_name] = {
                         "line": line,
                         "buffer": [],
-                        "ydata": Queue(),
+                        "ydata": deque(),
+                        "view": None,
                     }
-                    fig.suptitle(f"{names[i].capitalize()}: {var_name}")
+                    self._series_plot_packs.append(
+                        self.visualization_data[names[i]][var_name]
+                    )
+        for plot_pack in self._profile_plot_packs + self._series_plot_packs:
+            figure = plot_pack["line"].figure
+            if figure not in self._figure_lines:
+                self._figure_lines[figure] = []
+                figure.canvas.mpl_connect("draw_event", self._on_draw)
+                figure.canvas.mpl_connect("resize_event", self._on_resize)
+            self._figure_lines[figure].append(plot_pack["line"])
         if plot_intermediate_result_names is not None:
             for var_name in plot_intermediate_result_names:
                 self.adapter.monitor_intermediate_results(
                     var_name,
-                    step=10,
+                    step=self.inputs["intermediate_result_step"],
                     queue=self.visualization_data["intermediate_results"][
                         var_name
                     ]["ydata"],
                 )
 
+    @staticmethod
+    def _grow_view(plot_pack, xmin, xmax, ymin, ymax):
+        """Widen the view limits of a plot pack to include a data range.
+
+        The axes limits are only changed when the data leaves the
+        current view, and the new view is padded by 5% of its range so
+        that the following points usually fit without another change.
+
+        Parameters
+        ----------
+        plot_pack : dict
+            The plot pack whose line's axes are rescaled.
+        xmin, xmax, ymin, ymax : float
+            The bounding box of the new data. Nothing is done if it is
+            not finite.
+
+        Returns
+        -------
+        bool
+            Whether the axes limits were changed.
+        """
+        if not numpy.isfinite((xmin, xmax, ymin, ymax)).all():
+            return False
+        view = plot_pack["view"]
+        if view is not None:
+            if (
+                view[0] <= xmin
+                and xmax <= view[1]
+                and view[2] <= ymin
+                and ymax <= view[3]
+            ):
+                return False
+            xmin, xmax = min(xmin, view[0]), max(xmax, view[1])
+            ymin, ymax = min(ymin, view[2]), max(ymax, view[3])
+        xpad = 0.05 * (xmax - xmin) or 0.05 * abs(xmax) or 0.5
+        ypad = 0.05 * (ymax - ymin) or 0.05 * abs(ymax) or 0.5
+        plot_pack["view"] = view = (
+            xmin - xpad,
+            xmax + xpad,
+            ymin - ypad,
+            ymax + ypad,
+        )
+        axes = plot_pack["line"].axes
+        axes.set_xlim(view[0], view[1])
+        axes.set_ylim(view[2], view[3])
+        return True
+
+    def _on_draw(self, event):
+        # a full draw leaves out the animated lines, so cache the
+        # background for blitting and draw the lines on top of it. The
+        # event also fires when saving, where the canvas may be a vector
+        # canvas that cannot copy its background.
+        canvas = event.canvas
+        figure = canvas.figure
+        if hasattr(canvas, "copy_from_bbox"):
+            self._figure_backgrounds[figure] = (
+                canvas,
+                canvas.copy_from_bbox(figure.bbox),
+            )
+        for line in self._figure_lines[figure]:
+            line.draw(event.renderer)
+
+    def _on_resize(self, event):
+        # the cached background has the old size until the next full draw
+        self._figure_backgrounds.pop(event.canvas.figure, None)
+
     def _update_plot(self):
-        for key, plot_pack in self.visualization_data.items():
-            if key in ["ycalc", "y"]:
-                if not plot_pack["xdata"].empty():
-                    line = plot_pack["line"]
-                    xdata = plot_pack["xdata"].get()
-                    ydata = plot_pack["ydata"].get()
-                    line.set_xdata(xdata)
-                    line.set_ydata(ydata)
-                    line.axes.relim()
-                    line.axes.autoscale_view()
-            elif (
-                key == "variables"
-                or key == "results"
-                or key == "intermediate_results"
+        # take everything produced since the last update, the fit can be
+        # faster than the plot updates
+        updated_figures = set()
+        rescaled_figures = set()
+        for plot_pack in self._profile_plot_packs:
+            if plot_pack["data"]:
+                xdata, ydata = plot_pack["data"].pop()
+                plot_pack["line"].set_data(xdata, ydata)
+                if len(xdata) and self._grow_view(
+                    plot_pack,
+                    xdata.min(),
+                    xdata.max(),
+                    numpy.nanmin(ydata),
+                    numpy.nanmax(ydata),
+                ):
+                    rescaled_figures.add(plot_pack["line"].figure)
+                updated_figures.add(plot_pack["line"].figure)
+        for plot_pack in self._series_plot_packs:
+            buffer = plot_pack["buffer"]
+            buffer_length = len(buffer)
+            while plot_pack["ydata"]:
+                buffer.append(plot_pack["ydata"].popleft())
+            if len(buffer) > buffer_length:
+                plot_pack["line"].set_data(range(1, len(buffer) + 1), buffer)
+                # only the new points can move the bounding box
+                new_values = numpy.array(buffer[buffer_length:], dtype=float)
+                if not numpy.isnan(new_values).all() and self._grow_view(
+                    plot_pack,
+                    buffer_length + 1,
+                    len(buffer),
+                    numpy.nanmin(new_values),
+                    numpy.nanmax(new_values),
+                ):
+                    rescaled_figures.add(plot_pack["line"].figure)
+                updated_figures.add(plot_pack["line"].figure)
+        # redraw each figure once, fully if its limits changed, otherwise
+        # by blitting its lines onto the cached background
+        for figure in updated_figures:
+            canvas = figure.canvas
+            # a background from a savefig canvas does not fit this one
+            background_canvas, background = self._figure_backgrounds.get(
+                figure, (None, None)
+            )
+            if (
+                figure in rescaled_figures
+                or background_canvas is not canvas
+                or not canvas.supports_blit
             ):
-                for _, data_pack in plot_pack.items():
-                    if not data_pack["ydata"].empty():
-                        line = data_pack["line"]
-                        buffer = data_pack["buffer"]
-                        new_y = data_pack["ydata"].get()
-                        buffer.append(new_y)
-                        xdata = list(range(1, len(buffer) + 1))
-                        ydata = buffer
-                        line.set_xdata(xdata)
-                        line.set_ydata(ydata)
-                        line.axes.relim()
-                        line.axes.autoscale_view()
+                canvas.draw_idle()
+            else:
+                canvas.restore_region(background)
+                for line in self._figure_lines[figure]:
+                    figure.draw_artist(line)
+                canvas.blit(figure.bbox)
+
+    def _start_input_watcher(self, new_data_event):
+        """Start watching the input data directory for changes.
+
+        Only files closed after writing and files moved into the
+        directory are reported, and recorded as completely written.
+        Created and modified files may still be written, so they are
+        left to the polling in _check_for_new_data, which takes them
+        once they have not changed for _input_settle_time_ns. Files whose
+        writer never closes them, or whose close is not reported, e.g.
+        on network file systems such as NFS or by instruments writing
+        in place, are therefore only picked up by polling.
+
+        Parameters
+        ----------
+        new_data_event : threading.Event
+            The event to set when a file in the input data directory is
+            closed after writing or moved.
+
+        Returns
+        -------
+        watchdog.observers.Observer or None
+            The started observer, or None if watchdog is not installed.
+        """
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return None
+
+        written_input_names = self._written_input_names
+
+        class InputDataHandler(FileSystemEventHandler):
+            # created and modified files may still be written, so only
+            # closed files and renames mark a file as complete
+            def on_closed(self, event):
+                if not event.is_directory:
+                    written_input_names.add(Path(event.src_path).name)
+                    new_data_event.set()
+
+            def on_moved(self, event):
+                if not event.is_directory:
+                    written_input_names.add(Path(event.dest_path).name)
+                    new_data_event.set()
+
+        observer = Observer()
+        observer.schedule(InputDataHandler(), self.inputs["input_data_dir"])
+        observer.start()
+        return observer
 
     def _check_for_new_data(self):
         input_data_dir = self.inputs["input_data_dir"]
-        filename_order_pattern = self.inputs["filename_order_pattern"]
-        files = [file for file in Path(input_data_dir).glob("*")]
-        sorted_file = sorted(
-            files,
-            key=lambda file: int(
-                re.findall(filename_order_pattern, file.name)[0]
-            ),
-        )
-        if (
-            self.input_files_known
-            != sorted_file[: len(self.input_files_known)]
-        ):
+        # creating, deleting or renaming a file changes the directory
+        # mtime, so an unchanged mtime means there is nothing new
+        mtime_ns = os.stat(input_data_dir).st_mtime_ns
+        if mtime_ns == self._input_dir_mtime_ns:
+            return
+        # a recent mtime is not trusted, a coarse timestamp could stay the
+        # same across further changes
+        recent = time.time_ns() - mtime_ns < 2_000_000_000
+        self._input_dir_mtime_ns = None if recent else mtime_ns
+        # files that do not match the pattern, e.g. partially written
+        # files, are skipped until they are renamed
+        ordered_names = []
+        entries_by_name = {}
+        with os.scandir(input_data_dir) as entries:
+            for entry in entries:
+                order = self._filename_order(entry.name)
+                if order is not None and entry.is_file():
+                    ordered_names.append((order, entry.name))
+                    entries_by_name[entry.name] = entry
+        ordered_names.sort(key=lambda order_name: order_name[0])
+        sorted_names = [name for _, name in ordered_names]
+        known_count = len(self._input_file_names)
+        if self._input_file_names != sorted_names[:known_count]:
             raise RuntimeError(
                 "Wrong order to run sequential toolset is detected. "
                 "This is likely due to files appearing in the input directory "
                 "in the wrong order. Please restart the sequential toolset."
             )
-        if self.input_files_known == sorted_file:
+        if self._written_input_names is not None:
+            # in stream mode, stop at the first new file that may still be
+            # written, and scan again later as its size can change without
+            # changing the directory mtime
+            now_ns = time.time_ns()
+            for count in range(known_count, len(sorted_names)):
+                name = sorted_names[count]
+                if (
+                    name not in self._written_input_names
+                    and now_ns - entries_by_name[name].stat().st_mtime_ns
+                    < self._input_settle_time_ns
+                ):
+                    sorted_names = sorted_names[:count]
+                    self._input_dir_mtime_ns = None
+                    break
+        # the known files are a prefix, so equal lengths mean no new files
+        if len(sorted_names) == known_count:
             return
-        self.input_files_known = sorted_file
-        self.input_files_running = [
-            f
-            for f in self.input_files_known
-            if f not in self.input_files_completed
+        # only the new files are turned into paths
+        self.input_files_known.extend(
+            Path(input_data_dir) / name for name in sorted_names[known_count:]
+        )
+        self._input_file_names = sorted_names
+        # files are completed in order, so the completed files are a
+        # prefix of the known files
+        self.input_files_running = self.input_files_known[
+            len(self.input_files_completed) :
         ]
         print(f"{[str(f) for f in self.input_files_running]} detected.")
 
+    def _filename_order(self, filename):
+        """Get the order of the input file from its name.
+
+        The order is the first group matched by the filename order
+        pattern, or the whole match if the pattern has no group. None is
+        returned if the name does not match. Orders are cached by name, as
+        the same names are seen on every directory scan.
+        """
+        if filename not in self._filename_orders:
+            match = self._filename_order_re.search(filename)
+            self._filename_orders[filename] = (
+                None
+                if match is None
+                else int(match.group(1) if match.re.groups else match.group(0))
+            )
+        return self._filename_orders[filename]
+
     def set_start_input_file(
         self, input_filename, input_filename_to_result_filename
     ):
@@ -392,24 +898,24 @@ class SequentialCMIRunner:
         last_result_file = input_filename_to_result_filename(
             self.input_files_completed[-1].name
         )
-        last_result_file = (
-            Path(self.inputs["output_result_dir"]) / last_result_file
-        )
-        if not Path(last_result_file).exists():
+        last_result_file = self._output_result_dir / last_result_file
+        if not last_result_file.exists():
             raise FileNotFoundError(
                 f"Result file {last_result_file} not found. "
                 "Cannot load last result variable values. "
                 "Please check the provided function or use "
                 "an earlier input file."
             )
-        last_result_variables_values = json.load(open(last_result_file, "r"))[
-            "variables"
-        ]
-        last_result_variables_values = {
-            name: pack["value"]
-            for name, pack in last_result_variables_values.items()
+        # the variables that are not refined keep their initial values
+        self.last_result_variables_values = {
+            **self.inputs["initial_variable_values"],
+            **{
+                name: pack["value"]
+                for name, pack in _load_json(last_result_file)[
+                    "variables"
+                ].items()
+            },
         }
-        self.last_result_variables_values = last_result_variables_values
         print(f"Starting from input file: {self.input_files_running[0].name}")
 
     def _run_one_cycle(self, stop_event=SimpleNamespace(is_set=lambda: False)):
@@ -420,7 +926,6 @@ class SequentialCMIRunner:
         qmin = self.inputs["qmin"]
         qmax = self.inputs["qmax"]
         structure_path = self.inputs["structure_path"]
-        output_result_dir = self.inputs["output_result_dir"]
         initial_variable_values = self.inputs["initial_variable_values"]
         refinable_variable_names = self.inputs["refinable_variable_names"]
         if not self.input_files_running:
@@ -428,18 +933,32 @@ class SequentialCMIRunner:
         for input_file in self.input_files_running:
             if stop_event.is_set():
                 break
+            if self._skip_completed(input_file):
+                continue
             print(f"Processing {input_file.name}...")
-            self.adapter.initialize_profile(
-                str(input_file),
-                xmin=xmin,
-                xmax=xmax,
-                dx=dx,
-                qmin=qmin,
-                qmax=qmax,
-            )
-            self.adapter.initialize_structures([structure_path])
-            self.adapter.initialize_contribution()
-            self.adapter.initialize_recipe()
+            if self._recipe_initialized:
+                # the structure and variables are the same for all files
+                self.adapter.update_profile(
+                    str(input_file),
+                    xmin=xmin,
+                    xmax=xmax,
+                    dx=dx,
+                    qmin=qmin,
+                    qmax=qmax,
+                )
+            else:
+                self.adapter.initialize_profile(
+                    str(input_file),
+                    xmin=xmin,
+                    xmax=xmax,
+                    dx=dx,
+                    qmin=qmin,
+                    qmax=qmax,
+                )
+                self.adapter.initialize_structures([structure_path])
+                self.adapter.initialize_contribution()
+                self.adapter.initialize_recipe()
+                self._recipe_initialized = True
             if not hasattr(self, "last_result_variables_values"):
                 self.last_result_variables_values = initial_variable_values
             self.adapter.set_initial_variable_values(
@@ -448,42 +967,105 @@ class SequentialCMIRunner:
             if refinable_variable_names is None:
                 refinable_variable_names = list(initial_variable_values.keys())
             self.adapter.refine_variables(refinable_variable_names)
-            results = self.adapter.save_results(
-                filename=str(
-                    Path(output_result_dir) / f"{input_file.stem}_result.json"
-                ),
-                mode="dict",
+            results = self.adapter.save_results(mode="dict")
+            # the refined values are still in the recipe
+            values = self.adapter.snapshot_values()
+            profile = self.adapter.profile
+            self._record_result(
+                input_file,
+                results,
+                values,
+                (profile.x, profile.y, profile.ycalc),
             )
-            self.last_result_variables_values = {
-                name: pack["value"]
-                for name, pack in results["variables"].items()
-            }
-            self.input_files_completed.append(input_file)
-            if "ycalc" in self.visualization_data:
-                xdata = self.adapter.recipe.pdfcontribution.profile.x
-                ydata = self.adapter.recipe.pdfcontribution.profile.ycalc
-                self.visualization_data["ycalc"]["xdata"].put(xdata)
-                self.visualization_data["ycalc"]["ydata"].put(ydata)
-            if "y" in self.visualization_data:
-                xdata = self.adapter.recipe.pdfcontribution.profile.x
-                ydata = self.adapter.recipe.pdfcontribution.profile.y
-                self.visualization_data["y"]["xdata"].put(xdata)
-                self.visualization_data["y"]["ydata"].put(ydata)
-            for var_name in self.visualization_data.get("variables", {}):
-                new_value = self.adapter.recipe._parameters[var_name].value
-                self.visualization_data["variables"][var_name]["ydata"].put(
-                    new_value
-                )
-            for entry_name in self.visualization_data.get("results", {}):
-                fitresults_dict = self.adapter.save_results(mode="dict")
-                entry_value = fitresults_dict.get(entry_name, None)
-                self.visualization_data["results"][entry_name]["ydata"].put(
-                    entry_value
-                )
             print("Completed!")
         self.input_files_running = []
 
-    def run(self, mode: Literal["batch", "stream"]):
+    def _run_parallel_cycle(self, max_workers):
+        self._check_for_new_data()
+        if not hasattr(self, "last_result_variables_values"):
+            self.last_result_variables_values = self.inputs[
+                "initial_variable_values"
+            ]
+        input_files = self.input_files_running
+        # only the leading completed files are skipped
+        while input_files and self._skip_completed(input_files[0]):
+            input_files = input_files[1:]
+        with ProcessPoolExecutor(max_workers) as executor:
+            # each group starts from the result of the previous group
+            for start in range(0, len(input_files), max_workers):
+                group = input_files[start : start + max_workers]
+                print(f"Processing {[f.name for f in group]}...")
+                # the workers build a fresh recipe, so the fixed variables
+                # need their initial values as well
+                variable_values = {
+                    **self.inputs["initial_variable_values"],
+                    **self.last_result_variables_values,
+                }
+                futures = [
+                    executor.submit(
+                        _refine_file,
+                        input_file,
+                        self.inputs,
+                        variable_values,
+                    )
+                    for input_file in group
+                ]
+                for input_file, future in zip(group, futures):
+                    self._record_result(input_file, *future.result())
+                print("Completed!")
+        self.input_files_running = []
+
+    def _record_result(self, input_file, results, values, profile):
+        """Write the results of a refined file and queue its plot data.
+
+        Parameters
+        ----------
+        input_file : pathlib.Path
+            The refined input data file.
+        results : dict
+            The fit results, as returned by ``save_results(mode="dict")``.
+        values : dict
+            The refined values of all the recipe parameters.
+        profile : tuple of numpy.ndarray
+            The x, y and ycalc arrays of the refined profile.
+        """
+        item = (
+            results,
+            str(self._result_file(input_file)),
+            input_file,
+            self._input_fingerprint(input_file),
+        )
+        if self._writer is None or not self._writer.is_alive():
+            # outside of run nothing empties the queue, write right away
+            self._write_result(*item)
+        else:
+            # write in the background while the next file is refined
+            self._result_queue.put(item)
+        self.last_result_variables_values = {
+            name: values[name]
+            for name in self.inputs["refinable_variable_names"]
+        }
+        self.input_files_completed.append(input_file)
+        x, y, ycalc = profile
+        # a screen cannot show more points than this
+        stride = max(1, -(-len(x) // self._max_profile_plot_points))
+        x = x[::stride]
+        if "ycalc" in self.visualization_data:
+            self.visualization_data["ycalc"]["data"].append(
+                (x, ycalc[::stride])
+            )
+        if "y" in self.visualization_data:
+            self.visualization_data["y"]["data"].append((x, y[::stride]))
+        for var_name, variable_pack in self.visualization_data.get(
+            "variables", {}
+        ).items():
+            variable_pack["ydata"].append(values[var_name])
+        for entry_name, result_pack in self.visualization_data.get(
+            "results", {}
+        ).items():
+            result_pack["ydata"].append(results.get(entry_name, None))
+
+    def run(self, mode: Literal["batch", "stream"], max_workers=None):
         """Run the sequential refinement process in either batch or
         streaming mode.
 
@@ -496,21 +1078,64 @@ class SequentialCMIRunner:
             runner will continuously monitor the input data directory for new
             files and process them as they appear, until the user decides
             to stop the process.
+        max_workers : int, optional
+            The number of files refined at the same time in separate
+            processes in "batch" mode. Each group of files starts from the
+            refined values of the last file of the previous group, so the
+            results can differ from refining the files one at a time, and
+            intermediate results are not plotted. Default is None, which
+            refines the files one at a time.
         """
         if mode == "batch":
-            self._run_one_cycle()
+            writer = self._start_writer()
+            try:
+                if max_workers is not None and max_workers > 1:
+                    self._run_parallel_cycle(max_workers)
+                else:
+                    self._run_one_cycle()
+            except BaseException:
+                # the results refined so far are still written, but a write
+                # error must not replace the refinement error
+                self._stop_writer(writer, raise_error=False)
+                raise
+            self._stop_writer(writer)
             self._update_plot()
         elif mode == "stream":
+            from prompt_toolkit import PromptSession
+            from prompt_toolkit.patch_stdout import patch_stdout
+
             stop_event = threading.Event()
             session = PromptSession()
             if (self.visualization_data is not None) and self.show_plot:
                 plt.ion()
                 plt.pause(0.01)
 
+            new_data_event = threading.Event()
+            self._written_input_names = set()
+            observer = self._start_input_watcher(new_data_event)
+            stream_errors = []
+
             def stream_loop():
-                while not stop_event.is_set():
-                    self._run_one_cycle(stop_event)
-                    stop_event.wait(1)  # Check for new data every 1s
+                try:
+                    while not stop_event.is_set():
+                        new_data_event.clear()
+                        self._run_one_cycle(stop_event)
+                        # wake up early on the watcher, but keep polling
+                        # as it can miss events, e.g. on network drives
+                        new_data_event.wait(1)
+                except Exception as error:
+                    # stop the stream instead of silently stalling it,
+                    # the error is raised once the threads are stopped
+                    stream_errors.append(error)
+                    stop_event.set()
+                    print(
+                        f"Stopping the streaming sequential toolset: {error}"
+                    )
+                    if session.app.is_running:
+                        # end the prompt so that the input thread stops
+                        session.app.loop.call_soon_threadsafe(
+                            lambda: session.app.exit(result="")
+                        )
 
             def input_loop():
                 with patch_stdout():
@@ -519,8 +1144,11 @@ class SequentialCMIRunner:
                     print("================")
                     while not stop_event.is_set():
                         cmd = session.prompt("> ")
+                        if stop_event.is_set():
+                            break
                         if cmd.strip() == "STOP":
                             stop_event.set()
+                            new_data_event.set()
                             print(
                                 "Stopping the streaming sequential toolset..."
                             )
@@ -529,28 +1157,45 @@ class SequentialCMIRunner:
                                 "Unrecognized input. "
                                 "Please type 'STOP' to end."
                             )
-                    visualization_data = {}
-                    for (
-                        category_name,
-                        data_pack,
-                    ) in self.visualization_data.items():
-                        for var_name, var_pack in data_pack.items():
-                            if "buffer" in var_pack:
-                                visualization_data[category_name] = {
-                                    var_name: var_pack["buffer"]
-                                }
-                    with open("visualization_data.json", "w") as f:
-                        json.dump(visualization_data, f, indent=2)
-
-            input_thread = threading.Thread(target=input_loop)
+
+            # The worker threads never call matplotlib, they only append to
+            # the plot deques. All plotting happens here in the main thread.
+            input_thread = threading.Thread(target=input_loop, daemon=True)
             input_thread.start()
+            writer = self._start_writer()
             fit_thread = threading.Thread(target=stream_loop)
             fit_thread.start()
+            # _update_plot only redraws lines with new data, so it is cheap
+            # to poll often, and plt.pause keeps the figures responsive
+            # while waiting
             while not stop_event.is_set():
                 self._update_plot()
-                plt.pause(0.01)
-                time.sleep(1)
+                plt.pause(0.1)
             fit_thread.join()
-            input_thread.join()
+            # the prompt may not have started yet when the fit failed
+            input_thread.join(1 if stream_errors else None)
+            if observer:
+                observer.stop()
+                observer.join()
+            self._written_input_names = None
+            self._stop_writer(writer, raise_error=not stream_errors)
+            self._update_plot()
+            visualization_data = {
+                category_name: {
+                    var_name: var_pack["buffer"]
+                    for var_name, var_pack in self.visualization_data[
+                        category_name
+                    ].items()
+                }
+                for category_name in [
+                    "variables",
+                    "results",
+                    "intermediate_results",
+                ]
+                if category_name in self.visualization_data
+            }
+            _dump_json(visualization_data, "visualization_data.json")
+            if stream_errors:
+                raise stream_errors[0]
         else:
             raise ValueError(f"Unknown mode: {mode}")
@@ -1,6 +1,13 @@
 import pytest
 
 
+def pytest_configure(config):
+    # the fitting tests are independent, so they can be spread over
+    # workers with pytest-xdist, e.g. `pytest -n auto`, or skipped with
+    # `pytest -m "not heavy"`
+    config.addinivalue_line("markers", "heavy: slow tests that run fits")
+
+
 @pytest.fixture
 def user_filesystem(tmp_path):
     base_dir = tmp_path
@@ -1,12 +1,26 @@
+import json
+from collections import deque
 from pathlib import Path
+from queue import Queue
 
 import numpy
+import pytest
 from helper import make_cmi_recipe
 from scipy.optimize import least_squares
 
-from pdfbl.sequential.pdfadapter import PDFAdapter
+from pdfbl.sequential import pdfadapter
+from pdfbl.sequential.pdfadapter import (
+    PDFAdapter,
+    _default_equation_string,
+    _dump_json,
+    _geodesic_lm,
+    _load_json,
+    _put_nowait,
+    _variable_scale,
+)
 
 
+@pytest.mark.heavy
 def test_pdfadapter():
     # C1: Run the same fit with pdfadapter and diffpy_cmi
     #   Expect the refined parameters to be the same within 1e-5
@@ -57,10 +71,375 @@ def test_pdfadapter():
     adapter.refine_variables(
         variables_to_refine,
     )
-    pdfadapter_pv_dict = {}
-    for pname, parameter in adapter.recipe._parameters.items():
-        pdfadapter_pv_dict[pname] = parameter.value
-    for var_name in variables_to_refine:
-        diffpy_value = diffpy_pv_dict[var_name]
-        pdfadapter_value = pdfadapter_pv_dict[var_name]
-        assert numpy.isclose(diffpy_value, pdfadapter_value, atol=1e-5)
+    pdfadapter_pv_dict = adapter.snapshot_values()
+    numpy.testing.assert_allclose(
+        [diffpy_pv_dict[var_name] for var_name in variables_to_refine],
+        [pdfadapter_pv_dict[var_name] for var_name in variables_to_refine],
+        rtol=1e-5,
+        atol=1e-5,
+    )
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("s0", 0.1),
+        ("s2", 0.1),
+        ("qdamp", 0.01),
+        ("a_phase_1", 0.01),
+        ("x_phase_1_atom_2", 0.001),
+        ("Uiso_phase_1_atom_1", 0.001),
+        ("U11_phase_2_atom_1", 0.001),
+        ("U23_phase_1_atom_3", 0.001),
+        ("B11_phase_1_atom_1", 0.1),
+        ("unknown_phase_1", 1.0),
+    ],
+)
+def test_variable_scale(name, expected):
+    # C1: Get the preset scale of the variable name.
+    #   Expect the scale of its type, or 1 for unknown types
+    assert _variable_scale(name) == expected
+
+
+@pytest.mark.heavy
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"x_scale": "preset"},
+        {"intermediate_max_nfev": 5},
+        {"strategy": "joint"},
+        {"method": "geodesic-lm"},
+    ],
+)
+def test_refine_variables_options(options):
+    # C1: Refine with the preset variable scales.
+    # C2: Refine with a limit on the evaluations of the intermediate stages.
+    # C3: Refine all the variables at once.
+    # C4: Refine with the geodesic Levenberg-Marquardt driver.
+    #   Expect the same refined values as the default refinement
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    profile_path = Path(__file__).parent / "data" / "Ni.gr"
+    initial_pv_dict = {"s0": 0.4, "a_phase_1": 3.52}
+    variables_to_refine = ["a_phase_1", "s0"]
+    refined_pv_dicts = []
+    for refine_options in [{}, options]:
+        adapter = PDFAdapter()
+        adapter.initialize_profile(
+            str(profile_path), xmin=1.5, xmax=20, dx=0.01, qmax=25, qmin=0.1
+        )
+        adapter.initialize_structures([str(structure_path)])
+        adapter.initialize_contribution()
+        adapter.initialize_recipe()
+        adapter.set_initial_variable_values(initial_pv_dict)
+        adapter.refine_variables(variables_to_refine, **refine_options)
+        refined_pv_dicts.append(adapter.snapshot_values())
+    default_pv_dict, options_pv_dict = refined_pv_dicts
+    numpy.testing.assert_allclose(
+        [options_pv_dict[var_name] for var_name in variables_to_refine],
+        [default_pv_dict[var_name] for var_name in variables_to_refine],
+        rtol=1e-4,
+    )
+
+
+@pytest.mark.heavy
+def test_refine_variables_warm_start():
+    # C1: Refine with geodesic LM twice from the same starting values, the
+    #   second time from the Jacobian kept by the first refinement.
+    #   Expect the same refined values as the cold start
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    profile_path = Path(__file__).parent / "data" / "Ni.gr"
+    initial_pv_dict = {"s0": 0.4, "a_phase_1": 3.52}
+    variables_to_refine = ["a_phase_1", "s0"]
+    adapter = PDFAdapter()
+    adapter.initialize_profile(
+        str(profile_path), xmin=1.5, xmax=20, dx=0.01, qmax=25, qmin=0.1
+    )
+    adapter.initialize_structures([str(structure_path)])
+    adapter.initialize_contribution()
+    adapter.initialize_recipe()
+    adapter.set_initial_variable_values(initial_pv_dict)
+    adapter.refine_variables(variables_to_refine, method="geodesic-lm")
+    cold_pv_dict = adapter.snapshot_values()
+    assert ("a_phase_1", "s0") in adapter._jacobians
+    adapter.recipe.fix("all")
+    adapter.set_initial_variable_values(initial_pv_dict)
+    adapter.refine_variables(variables_to_refine, method="geodesic-lm")
+    warm_pv_dict = adapter.snapshot_values()
+    numpy.testing.assert_allclose(
+        [warm_pv_dict[var_name] for var_name in variables_to_refine],
+        [cold_pv_dict[var_name] for var_name in variables_to_refine],
+        rtol=1e-4,
+    )
+    # C2: Load the profile on a shorter r grid and refine again.
+    #   Expect the kept Jacobian of the wrong shape to be ignored
+    adapter.update_profile(
+        str(profile_path), xmin=1.5, xmax=15, dx=0.01, qmax=25, qmin=0.1
+    )
+    adapter.set_initial_variable_values(initial_pv_dict)
+    adapter.refine_variables(variables_to_refine, method="geodesic-lm")
+    assert adapter._jacobians[("a_phase_1", "s0")].shape == (
+        len(adapter.profile.x),
+        2,
+    )
+
+
+def test_geodesic_lm():
+    # C1: Fit an exponential decay with the geodesic LM driver and
+    #   scipy least_squares.
+    #   Expect the fitted values to be the same within 1e-5
+    x = numpy.linspace(0, 5, 200)
+    y = 3 * numpy.exp(-1.3 * x) + 0.5 + 0.01 * numpy.sin(7 * x)
+
+    def residual(p):
+        return p[0] * numpy.exp(-p[1] * x) + p[2] - y
+
+    expected = least_squares(residual, [1, 0.2, 0], x_scale="jac").x
+    actual, _ = _geodesic_lm(residual, [1, 0.2, 0])
+    assert numpy.allclose(actual, expected, atol=1e-5)
+    # C2: Fit with an extra variable that has no effect on the residual
+    #   and no damping, so that the damped J^T J is singular.
+    #   Expect the same fitted values, and the extra variable unchanged
+    actual, _ = _geodesic_lm(
+        lambda p: residual(p[:3]),
+        [1, 0.2, 0, 4],
+        x_scale=[1, 1, 1, numpy.inf],
+    )
+    assert numpy.allclose(actual[:3], expected, atol=1e-5)
+    assert actual[3] == 4
+
+
+def test_default_equation_string():
+    # C1: Build the default equation for one, two and three phases.
+    #   Expect the phase fractions to sum to one
+    assert _default_equation_string(1) == "s0*G1"
+    assert _default_equation_string(2) == "s0*(s1*G1+(1-(s1))*G2)"
+    assert _default_equation_string(3) == "s0*(s1*G1+s2*G2+(1-(s1+s2))*G3)"
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_non_finite_round_trip(tmp_path, monkeypatch, use_orjson):
+    # C1: Write and read results holding NaN and infinite values, with and
+    #   without orjson.
+    #   Expect the values to be read back as floats, and the same file in
+    #   both cases
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(pdfadapter, "orjson", None)
+    results = {
+        "rw": float("nan"),
+        "variables": {"s0": {"value": 0.4, "uncertainty": numpy.inf}},
+        "covariance_matrix": numpy.array([[1.0, numpy.nan], [0.5, 2.0]]),
+    }
+    filename = tmp_path / "result.json"
+    _dump_json(results, filename)
+    loaded = _load_json(filename)
+    assert numpy.isnan(loaded["rw"])
+    assert loaded["variables"]["s0"] == {
+        "value": 0.4,
+        "uncertainty": numpy.inf,
+    }
+    numpy.testing.assert_array_equal(
+        loaded["covariance_matrix"], results["covariance_matrix"]
+    )
+    expected = json.dumps(
+        {**results, "covariance_matrix": [[1.0, numpy.nan], [0.5, 2.0]]},
+        indent=2,
+    )
+    assert filename.read_text() == expected
+
+
+def test_get_pool_bad_ncpu(monkeypatch):
+    # C1: PDFBL_NCPU is not an integer.
+    #   Expect a ValueError naming the environment variable
+    monkeypatch.setattr(pdfadapter, "_pool", None)
+    monkeypatch.setenv("PDFBL_NCPU", "four")
+    with pytest.raises(ValueError, match="PDFBL_NCPU"):
+        pdfadapter._get_pool()
+
+
+def test_put_nowait():
+    # C1: Put five values into a queue holding two.
+    #   Expect the two latest values to be kept, and the queue to join
+    queue = Queue(maxsize=2)
+    for value in range(5):
+        _put_nowait(queue, value)
+    assert [queue.get_nowait() for _ in range(2)] == [3, 4]
+    queue.task_done()
+    queue.task_done()
+    queue.join()
+    # C2: Put five values into a deque holding two.
+    #   Expect the two latest values to be kept
+    values = deque(maxlen=2)
+    for value in range(5):
+        _put_nowait(values, value)
+    assert list(values) == [3, 4]
+    # C3: Monitor results with the default queue and with maxsize=2.
+    #   Expect the default queue to keep every result
+    adapter = PDFAdapter()
+    adapter.monitor_intermediate_results("rw")
+    adapter.monitor_intermediate_results("chi2", maxsize=2)
+    assert adapter.intermediate_results[("rw", 10)].maxsize == 0
+    assert adapter.intermediate_results[("chi2", 10)].maxsize == 2
+
+
+def test_two_phase_recipe():
+    # C1: Build a recipe from two copies of the Ni structure.
+    #   Expect one phase fraction s1, with the second phase taking the
+    #   rest, so that the fractions sum to one and the calculated PDF is
+    #   the single-phase one for any s1
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    profile_path = Path(__file__).parent / "data" / "Ni.gr"
+    pv_dict = {"s0": 0.4, "a_phase_1": 3.52, "a_phase_2": 3.52}
+    calculated = []
+    for structure_paths in [[structure_path], [structure_path] * 2]:
+        adapter = PDFAdapter()
+        adapter.initialize_profile(
+            str(profile_path), xmin=1.5, xmax=20, dx=0.01, qmax=25, qmin=0.1
+        )
+        adapter.initialize_structures([str(path) for path in structure_paths])
+        adapter.initialize_contribution()
+        adapter.initialize_recipe()
+        adapter.set_initial_variable_values(
+            {
+                name: value
+                for name, value in pv_dict.items()
+                if name in adapter.recipe._parameters
+            }
+        )
+        calculated.append(adapter.contribution.evaluate())
+    variable_names = adapter.get_variable_names()
+    assert "s1" in variable_names
+    assert "s2" not in variable_names
+    assert adapter.recipe.s1.value == 0.5
+    assert adapter.contribution.getEquation() == (
+        "(s0 * ((s1 * G1()) + ((1 - s1) * G2())))"
+    )
+    numpy.testing.assert_allclose(calculated[1], calculated[0])
+    adapter.set_initial_variable_values({"s1": 0.3})
+    numpy.testing.assert_allclose(
+        adapter.contribution.evaluate(), calculated[0]
+    )
+
+
+def test_list_recipe_parameters():
+    # C1: List the recipe variables of the Ni structure without a profile.
+    #   Expect the same names as the recipe built with a profile
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    profile_path = (
+        Path(__file__).parent
+        / "data"
+        / "input_data_dir"
+        / "Ni_PDF_20250923-065606_148a45_300K.gr"
+    )
+    adapter = PDFAdapter()
+    adapter.initialize_profile(str(profile_path))
+    adapter.initialize_structures([str(structure_path)])
+    adapter.initialize_contribution()
+    adapter.initialize_recipe()
+    expected = list(adapter.recipe._parameters.keys())
+    actual = PDFAdapter.list_recipe_parameters([str(structure_path)])
+    assert actual == expected
+
+
+def test_intermediate_results_fixed_values():
+    # C1: Monitor rw, then change a fixed variable between two residual
+    #   calls with the same free variable values.
+    #   Expect the second rw to reflect the new fixed value
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    profile_path = Path(__file__).parent / "data" / "Ni.gr"
+    adapter = PDFAdapter()
+    adapter.initialize_profile(
+        str(profile_path), xmin=1.5, xmax=50, dx=0.01, qmax=25, qmin=0.1
+    )
+    adapter.initialize_structures([str(structure_path)])
+    adapter.initialize_contribution()
+    adapter.initialize_recipe()
+    adapter.monitor_intermediate_results("rw", step=1)
+    adapter.set_initial_variable_values({"s0": 0.4, "a_phase_1": 3.52})
+    adapter.recipe.free("s0")
+    adapter.residual([0.4])
+    adapter.set_initial_variable_values({"a_phase_1": 3.6})
+    adapter.residual([0.4])
+    rw_queue = adapter.intermediate_results[("rw", 1)]
+    first_rw, second_rw = rw_queue.get_nowait(), rw_queue.get_nowait()
+    assert first_rw != second_rw
+
+
+def test_save_results_messages():
+    # C1: Save the results twice after a message was added to them.
+    #   Expect the second results to not repeat the old message
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    profile_path = Path(__file__).parent / "data" / "Ni.gr"
+    adapter = PDFAdapter()
+    adapter.initialize_profile(
+        str(profile_path), xmin=1.5, xmax=50, dx=0.01, qmax=25, qmin=0.1
+    )
+    adapter.initialize_structures([str(structure_path)])
+    adapter.initialize_contribution()
+    adapter.initialize_recipe()
+    adapter.set_initial_variable_values(
+        {"s0": 0.4, "a_phase_1": 3.52, "delta2_phase_1": 2}
+    )
+    adapter.recipe.free("s0")
+    adapter.save_results(mode="str")
+    adapter._fit_results.messages.append("Cannot compute covariance matrix.")
+    results_str = adapter.save_results(mode="str")
+    assert "Cannot compute covariance matrix." not in results_str
+
+
+@pytest.mark.heavy
+def test_update_profile(tmp_path):
+    # C1: Refine a profile, then load a second profile with a different
+    #   Q range and scale into the same recipe and refine it again.
+    #   Expect the same generators and refined values as a recipe built
+    #   from the second profile directly
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    profile_path = Path(__file__).parent / "data" / "Ni.gr"
+    r, g = numpy.loadtxt(profile_path, skiprows=21, unpack=True)
+    second_profile_path = tmp_path / "Ni_scaled.gr"
+    numpy.savetxt(
+        second_profile_path,
+        numpy.column_stack([r, 0.8 * g]),
+        header="qmax = 20.0\n\n#### start data\n#S 1\n#L r G",
+        comments="",
+    )
+    initial_pv_dict = {"s0": 0.4, "qdamp": 0.04, "a_phase_1": 3.52}
+    variables_to_refine = ["a_phase_1", "s0", "qdamp"]
+    updated = PDFAdapter()
+    updated.initialize_profile(str(profile_path), xmin=1.5, xmax=20, dx=0.01)
+    updated.initialize_structures([str(structure_path)])
+    updated.initialize_contribution()
+    updated.initialize_recipe()
+    updated.set_initial_variable_values(initial_pv_dict)
+    updated.refine_variables(variables_to_refine)
+    updated.update_profile(
+        str(second_profile_path), xmin=1.5, xmax=20, dx=0.01
+    )
+    updated.set_initial_variable_values(initial_pv_dict)
+    updated.refine_variables(variables_to_refine)
+    fresh = PDFAdapter()
+    fresh.initialize_profile(
+        str(second_profile_path), xmin=1.5, xmax=20, dx=0.01
+    )
+    fresh.initialize_structures([str(structure_path)])
+    fresh.initialize_contribution()
+    fresh.initialize_recipe()
+    fresh.set_initial_variable_values(initial_pv_dict)
+    fresh.refine_variables(variables_to_refine)
+    for updated_generator, fresh_generator in zip(
+        updated.pdfgenerators, fresh.pdfgenerators
+    ):
+        assert updated_generator.meta == fresh_generator.meta
+        assert updated_generator.getQmin() == fresh_generator.getQmin()
+        assert updated_generator.getQmax() == fresh_generator.getQmax()
+    numpy.testing.assert_array_equal(updated.profile.x, fresh.profile.x)
+    numpy.testing.assert_array_equal(updated.profile.y, fresh.profile.y)
+    updated_pv_dict = updated.snapshot_values()
+    fresh_pv_dict = fresh.snapshot_values()
+    numpy.testing.assert_allclose(
+        [updated_pv_dict[var_name] for var_name in fresh_pv_dict],
+        list(fresh_pv_dict.values()),
+        rtol=1e-5,
+        atol=1e-5,
+    )
@@ -1,7 +1,16 @@
+import json
+import os
+import threading
+import time
 from pathlib import Path
 
+import numpy
 import pytest
+from matplotlib import pyplot as plt
+from matplotlib.backend_bases import ResizeEvent
 
+from pdfbl.sequential import pdfadapter
+from pdfbl.sequential.pdfadapter import PDFAdapter
 from pdfbl.sequential.sequential_cmi_runner import SequentialCMIRunner
 
 
@@ -52,8 +61,202 @@ def test_load_inputs_bad(user_filesystem):
     )
     actual_error_msg = str(excinfo.value)
     assert expected_error_msg in actual_error_msg
+    # C4: several variable names not exist in recipe.
+    #   Expect one ValueError listing all of them.
+    runner = SequentialCMIRunner()
+    with pytest.raises(ValueError) as excinfo:
+        runner.load_inputs(
+            input_data_dir=str(input_data_folder),
+            structure_path=str(structure_path),
+            output_result_dir=str(result_folder),
+            refinable_variable_names=["s0", "bad_1", "bad_2"],
+        )
+    expected_error_msg = (
+        "Refinable variable 'bad_1', 'bad_2' not found in the "
+        "recipe. Please choose from the existing variables: "
+    )
+    actual_error_msg = str(excinfo.value)
+    assert expected_error_msg in actual_error_msg
+
+
+def test_check_for_new_data_mtime(user_filesystem, monkeypatch):
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+    )
+    # C1: the directory was last changed long ago.
+    #   Expect the files to be found, and the next call with an unchanged
+    #   directory mtime to return without listing the directory.
+    old_ns = time.time_ns() - 60_000_000_000
+    os.utime(input_data_folder, ns=(old_ns, old_ns))
+    runner._check_for_new_data()
+    assert len(runner.input_files_known) == 5
+
+    def no_scandir(path):
+        raise AssertionError("the directory was listed")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "scandir", no_scandir)
+        runner._check_for_new_data()
+    assert len(runner.input_files_known) == 5
+    # C2: a file is added within the 2 s window in which a coarse directory
+    #   mtime may not change.
+    #   Expect the recent mtime not to be trusted, and the file to be
+    #   picked up by the next call although the mtime is the same.
+    recent_ns = time.time_ns()
+    (input_data_folder / "Ni_PDF_60K.gr").write_text("Sample data content")
+    os.utime(input_data_folder, ns=(recent_ns, recent_ns))
+    runner._check_for_new_data()
+    (input_data_folder / "Ni_PDF_70K.gr").write_text("Sample data content")
+    os.utime(input_data_folder, ns=(recent_ns, recent_ns))
+    runner._check_for_new_data()
+    assert [f.name for f in runner.input_files_known[-2:]] == [
+        "Ni_PDF_60K.gr",
+        "Ni_PDF_70K.gr",
+    ]
+
+
+def test_check_for_new_data_stream(user_filesystem):
+    # C1: in stream mode, all input files were just written.
+    #   Expect them to be held back, as they may still be written.
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+    )
+    runner._written_input_names = set()
+    runner._check_for_new_data()
+    assert runner.input_files_known == []
+    # C2: the first file is reported as written by the watcher.
+    #   Expect only the first file to be taken.
+    runner._written_input_names.add("Ni_PDF_10K.gr")
+    runner._check_for_new_data()
+    assert [f.name for f in runner.input_files_known] == ["Ni_PDF_10K.gr"]
+    # C3: the other files have not changed for a while.
+    #   Expect all files to be taken, in order.
+    settled_ns = time.time_ns() - 10 * runner._input_settle_time_ns
+    for input_file in input_data_folder.iterdir():
+        os.utime(input_file, ns=(settled_ns, settled_ns))
+    runner._check_for_new_data()
+    assert [f.name for f in runner.input_files_known] == [
+        f"Ni_PDF_{(i + 1) * 10}K.gr" for i in range(5)
+    ]
+
+
+def test_start_input_watcher(user_filesystem):
+    # C1: a file is created, written and closed in the watched folder.
+    #   Expect the watcher to report it as written.
+    pytest.importorskip("watchdog")
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+    )
+    runner._written_input_names = set()
+    new_data_event = threading.Event()
+    observer = runner._start_input_watcher(new_data_event)
+    try:
+        (input_data_folder / "Ni_PDF_60K.gr").write_text("Sample data")
+        assert new_data_event.wait(5)
+        assert "Ni_PDF_60K.gr" in runner._written_input_names
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def test_record_result_empty_profile(user_filesystem):
+    # C1: record the result of a file whose profile has no points.
+    #   Expect empty profiles to be queued for plotting.
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        whether_plot_y=True,
+        whether_plot_ycalc=True,
+        show_plot=False,
+    )
+    empty = numpy.empty(0)
+    runner._record_result(
+        input_data_folder / "Ni_PDF_10K.gr", {}, {}, (empty, empty, empty)
+    )
+    for name in ["y", "ycalc"]:
+        x, y = runner.visualization_data[name]["data"][-1]
+        assert len(x) == len(y) == 0
+
+
+def test_record_result_without_writer(user_filesystem):
+    # C1: record more results than the result queue holds outside of run.
+    #   Expect every result to be written right away instead of blocking.
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        show_plot=False,
+    )
+    empty = numpy.empty(0)
+    input_files = sorted(input_data_folder.iterdir())
+    for input_file in input_files:
+        runner._record_result(input_file, {}, {}, (empty, empty, empty))
+    for input_file in input_files:
+        assert (result_folder / f"{input_file.stem}_result.json").exists()
 
 
+def test_run_write_error_after_refinement_error(user_filesystem):
+    # C1: a refinement fails after a result that cannot be written was
+    #   recorded.
+    #   Expect run to raise the refinement error, not the write error.
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        show_plot=False,
+    )
+    input_file = input_data_folder / "Ni_PDF_10K.gr"
+    (result_folder / "Ni_PDF_10K_result.json").mkdir()
+
+    def failing_cycle():
+        empty = numpy.empty(0)
+        runner._record_result(input_file, {}, {}, (empty, empty, empty))
+        raise RuntimeError("refinement failed")
+
+    runner._run_one_cycle = failing_cycle
+    with pytest.raises(RuntimeError, match="refinement failed"):
+        runner.run(mode="batch")
+    assert runner._completed_fingerprints == {}
+
+
+@pytest.mark.heavy
 def test_run_sequential_cmi_runner(user_filesystem):
     # C1: run the sequential CMI runner in batch mode.
     #   Expect result files are generated in the output folder.
@@ -94,10 +297,257 @@ def test_run_sequential_cmi_runner(user_filesystem):
     result_file_path = (
         Path(result_folder) / "Ni_PDF_20250923-065606_148a45_300K_result.json"
     )
-    print(list(result_folder.iterdir()))
-    assert result_file_path.exists()
+    assert result_file_path.exists(), sorted(
+        path.name for path in result_folder.iterdir()
+    )
+    # C2: run again on the same input and output folders.
+    #   Expect the refined file is skipped and its result kept.
+    result_mtime = result_file_path.stat().st_mtime_ns
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        refinable_variable_names=refinable_variable_names,
+        initial_variable_values=initial_variable_values,
+        xmin=1.5,
+        xmax=25.0,
+        dx=0.01,
+        qmax=25,
+        qmin=0.1,
+    )
+    runner.run(mode="batch")
+    assert result_file_path.stat().st_mtime_ns == result_mtime
+    assert [f.name for f in runner.input_files_completed] == [
+        "Ni_PDF_20250923-065606_148a45_300K.gr"
+    ]
+    assert set(runner.last_result_variables_values) == set(
+        refinable_variable_names
+    )
+    # C3: run again with a different r range and a fixed variable.
+    #   Expect the file to be refined again.
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        refinable_variable_names=refinable_variable_names[:-1],
+        initial_variable_values=initial_variable_values,
+        xmin=1.5,
+        xmax=20.0,
+        dx=0.01,
+        qmax=25,
+        qmin=0.1,
+    )
+    runner.run(mode="batch")
+    assert result_file_path.stat().st_mtime_ns != result_mtime
+    # C4: run again with the same settings as C3.
+    #   Expect the file to be skipped, and the fixed variable to keep its
+    #   initial value.
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        refinable_variable_names=refinable_variable_names[:-1],
+        initial_variable_values=initial_variable_values,
+        xmin=1.5,
+        xmax=20.0,
+        dx=0.01,
+        qmax=25,
+        qmin=0.1,
+    )
+    result_mtime = result_file_path.stat().st_mtime_ns
+    runner.run(mode="batch")
+    assert result_file_path.stat().st_mtime_ns == result_mtime
+    assert runner.last_result_variables_values["qbroad"] == 0.02
+
+
+@pytest.mark.heavy
+def test_run_sequential_cmi_runner_changed_file(user_filesystem):
+    # C1: refine three files, change the middle one and run again.
+    #   Expect the first file to be skipped, and the changed file and the
+    #   file after it, which starts from its result, to be refined again.
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "changed_input_data_dir"
+    input_data_folder.mkdir()
+    data_file = (
+        Path(__file__).parent
+        / "data"
+        / "input_data_dir"
+        / "Ni_PDF_20250923-065606_148a45_300K.gr"
+    )
+    r, g = numpy.loadtxt(data_file, skiprows=25, unpack=True)
+    for temperature, scale in [(300, 1.0), (310, 0.9), (320, 0.8)]:
+        numpy.savetxt(
+            input_data_folder / f"Ni_PDF_{temperature}K.gr",
+            numpy.column_stack([r, scale * g]),
+        )
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    inputs = dict(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        refinable_variable_names=["a_phase_1", "s0"],
+        initial_variable_values={"s0": 0.4, "a_phase_1": 3.52},
+        xmin=1.5,
+        xmax=25.0,
+        dx=0.01,
+        qmax=25,
+        qmin=0.1,
+    )
+    runner = SequentialCMIRunner()
+    runner.load_inputs(**inputs)
+    runner.run(mode="batch")
+    result_files = [
+        result_folder / f"Ni_PDF_{temperature}K_result.json"
+        for temperature in [300, 310, 320]
+    ]
+    result_mtimes = [path.stat().st_mtime_ns for path in result_files]
+    numpy.savetxt(
+        input_data_folder / "Ni_PDF_310K.gr",
+        numpy.column_stack([r, 0.7 * g]),
+    )
+    runner = SequentialCMIRunner()
+    runner.load_inputs(**inputs)
+    runner.run(mode="batch")
+    assert [
+        path.stat().st_mtime_ns != mtime
+        for path, mtime in zip(result_files, result_mtimes)
+    ] == [False, True, True]
+
+
+@pytest.mark.heavy
+def test_run_sequential_cmi_runner_write_error(user_filesystem):
+    # C1: the result file cannot be written.
+    #   Expect the error to be raised by run, and the input file not to be
+    #   marked as completed.
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = Path(__file__).parent / "data" / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    result_file_path = (
+        result_folder / "Ni_PDF_20250923-065606_148a45_300K_result.json"
+    )
+    result_file_path.mkdir()
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        refinable_variable_names=["a_phase_1", "s0"],
+        initial_variable_values={"s0": 0.4, "a_phase_1": 3.52},
+        xmin=1.5,
+        xmax=25.0,
+        dx=0.01,
+        qmax=25,
+        qmin=0.1,
+    )
+    with pytest.raises(OSError):
+        runner.run(mode="batch")
+    assert runner._completed_fingerprints == {}
+    assert not (result_folder / ".completed.json").exists()
+
+
+@pytest.mark.heavy
+def test_run_sequential_cmi_runner_parallel(user_filesystem, monkeypatch):
+    # C1: run the sequential CMI runner in batch mode with two workers on
+    #   three different profiles, with qbroad fixed away from its default.
+    #   Expect a result file for every input file, in order, no pool
+    #   started inside the workers, and qbroad kept at its initial value
+    #   in every group.
+    def _no_pool():
+        raise AssertionError("a pool was started inside a worker")
+
+    monkeypatch.setattr(pdfadapter, "_get_pool", _no_pool)
+    monkeypatch.setattr(PDFAdapter, "_parallel_threshold", 0)
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = user_filesystem / "parallel_input_data_dir"
+    input_data_folder.mkdir()
+    data_file = (
+        Path(__file__).parent
+        / "data"
+        / "input_data_dir"
+        / "Ni_PDF_20250923-065606_148a45_300K.gr"
+    )
+    r, g = numpy.loadtxt(data_file, skiprows=25, unpack=True)
+    for temperature, scale in [(300, 1.0), (310, 0.9), (320, 0.8)]:
+        numpy.savetxt(
+            input_data_folder / f"Ni_PDF_{temperature}K.gr",
+            numpy.column_stack([r, scale * g]),
+        )
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    refinable_variable_names = ["a_phase_1", "s0", "qdamp"]
+    initial_variable_values = {
+        "s0": 0.4,
+        "qdamp": 0.04,
+        "a_phase_1": 3.52,
+        "qbroad": 0.03,
+    }
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        refinable_variable_names=refinable_variable_names,
+        initial_variable_values=initial_variable_values,
+        xmin=1.5,
+        xmax=25.0,
+        dx=0.01,
+        qmax=25,
+        qmin=0.1,
+        plot_variable_names=["a_phase_1"],
+        show_plot=False,
+    )
+    runner.run(mode="batch", max_workers=2)
+    scales = []
+    for temperature in [300, 310, 320]:
+        result_file = result_folder / f"Ni_PDF_{temperature}K_result.json"
+        results = json.loads(result_file.read_text())
+        assert results["fixed_variables"]["qbroad"]["value"] == 0.03
+        scales.append(results["variables"]["s0"]["value"])
+    assert scales[0] > scales[1] > scales[2]
+    assert [f.name for f in runner.input_files_completed] == [
+        "Ni_PDF_300K.gr",
+        "Ni_PDF_310K.gr",
+        "Ni_PDF_320K.gr",
+    ]
+    buffer = runner.visualization_data["variables"]["a_phase_1"]["buffer"]
+    assert len(buffer) == 3
+
 
+def test_grow_view():
+    fig, axes = plt.subplots()
+    (line,) = axes.plot([], [])
+    plot_pack = {"line": line, "view": None}
+    # C1: the first data range.
+    #   Expect the view to cover it with a 5% padding.
+    assert SequentialCMIRunner._grow_view(plot_pack, 0, 10, 0, 1)
+    assert axes.get_xlim() == pytest.approx((-0.5, 10.5))
+    assert axes.get_ylim() == pytest.approx((-0.05, 1.05))
+    # C2: data inside the current view, and data that is not finite.
+    #   Expect the limits to be left unchanged.
+    assert not SequentialCMIRunner._grow_view(plot_pack, 1, 9, 0.2, 0.8)
+    assert not SequentialCMIRunner._grow_view(plot_pack, 0, numpy.nan, 0, 100)
+    assert axes.get_xlim() == pytest.approx((-0.5, 10.5))
+    assert axes.get_ylim() == pytest.approx((-0.05, 1.05))
+    # C3: data beyond the current x and y limits.
+    #   Expect the limits to expand to include it and the old view.
+    assert SequentialCMIRunner._grow_view(plot_pack, 5, 20, -1, 0.5)
+    xmin, xmax = axes.get_xlim()
+    ymin, ymax = axes.get_ylim()
+    assert xmin < -0.5 and xmax > 20
+    assert ymin < -1 and ymax > 1.05
+    assert plot_pack["view"] == pytest.approx((xmin, xmax, ymin, ymax))
+    plt.close(fig)
 
+
+@pytest.mark.heavy
 def test_data_for_plot(user_filesystem):
     # C1: plot_variable_names, plot_result_entry_names,
     #   plot_intermediate_results are provided.
@@ -165,3 +615,108 @@ def test_data_for_plot(user_filesystem):
         for _, plot_pack in runner.visualization_data[name].items():
             buffer = plot_pack["buffer"]
             assert len(buffer) > 0
+
+
+@pytest.mark.heavy
+def test_save_plots(user_filesystem):
+    # C1: save the live plots to raster and vector files after running.
+    #   Expect every figure to be saved without errors.
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = Path(__file__).parent / "data" / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    plt.close("all")
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        refinable_variable_names=["a_phase_1", "s0"],
+        initial_variable_values={"s0": 0.4, "a_phase_1": 3.52},
+        xmin=1.5,
+        xmax=25.0,
+        dx=0.01,
+        qmax=25,
+        qmin=0.1,
+        whether_plot_y=True,
+        whether_plot_ycalc=True,
+        plot_variable_names=["a_phase_1"],
+        plot_result_names=["chi2"],
+        show_plot=False,
+    )
+    runner.run(mode="batch")
+    figure_numbers = plt.get_fignums()
+    assert len(figure_numbers) == 3
+    for number in figure_numbers:
+        figure = plt.figure(number)
+        figure.canvas.draw()
+        for suffix in ["png", "pdf", "svg"]:
+            path = user_filesystem / f"figure_{number}.{suffix}"
+            figure.savefig(path)
+            assert path.stat().st_size > 0
+    # Expect the plots to still update after saving.
+    runner._update_plot()
+    plt.close("all")
+
+
+@pytest.mark.heavy
+def test_update_plot_blit(user_filesystem, monkeypatch):
+    result_folder = user_filesystem / "empty_folder"
+    input_data_folder = Path(__file__).parent / "data" / "input_data_dir"
+    structure_path = Path(__file__).parent / "data" / "Ni.cif"
+    plt.close("all")
+    runner = SequentialCMIRunner()
+    runner.load_inputs(
+        input_data_dir=str(input_data_folder),
+        structure_path=str(structure_path),
+        output_result_dir=str(result_folder),
+        filename_order_pattern=r"(\d+)K\.gr",
+        whether_plot_y=True,
+        show_plot=False,
+    )
+    plot_pack = runner.visualization_data["y"]
+    figure = plot_pack["line"].figure
+    canvas = figure.canvas
+    calls = []
+    for name in ["draw_idle", "restore_region", "blit"]:
+        monkeypatch.setattr(
+            canvas,
+            name,
+            lambda *args, name=name: calls.append(name),
+        )
+    xdata = numpy.linspace(0, 10, 11)
+    # C1: the first data, before any full draw.
+    #   Expect a full redraw, there is no background to blit onto.
+    plot_pack["data"].append((xdata, numpy.sin(xdata)))
+    runner._update_plot()
+    assert calls == ["draw_idle"]
+    # C2: data inside the view after a full draw of the canvas.
+    #   Expect the cached background to be restored and blitted.
+    canvas.draw()
+    assert runner._figure_backgrounds[figure][0] is canvas
+    background = runner._figure_backgrounds[figure][1]
+    calls.clear()
+    plot_pack["data"].append((xdata, 0.5 * numpy.sin(xdata)))
+    runner._update_plot()
+    assert calls == ["restore_region", "blit"]
+    # C3: the figure is resized and drawn again.
+    #   Expect the draw event to replace the background with one of the
+    #   new size, and the updates to blit onto it.
+    figure.set_size_inches(figure.get_size_inches() * 2)
+    canvas.draw()
+    new_background = runner._figure_backgrounds[figure][1]
+    assert new_background is not background
+    assert new_background.get_extents()[2] > background.get_extents()[2]
+    calls.clear()
+    plot_pack["data"].append((xdata, 0.2 * numpy.sin(xdata)))
+    runner._update_plot()
+    assert calls == ["restore_region", "blit"]
+    # C4: the canvas is resized, and updated before the next full draw.
+    #   Expect the stale background to be dropped, and a full redraw.
+    ResizeEvent("resize_event", canvas)._process()
+    assert figure not in runner._figure_backgrounds
+    calls.clear()
+    plot_pack["data"].append((xdata, 0.1 * numpy.sin(xdata)))
+    runner._update_plot()
+    assert calls == ["draw_idle"]
+    plt.close("all")